@@ -0,0 +1,340 @@
+"""Benchmark the vault on synthetic vaults of growing size.
+
+    python benchmark.py [--sizes 100,1000,10000,100000] [--backends csv,db] [--sync-changes 10] [--secrets 200] [--output FILE]
+
+For every backend and size a vault of generated entries is written to a
+temporary directory and timed: encrypting and saving it, loading it in a
+fresh instance, along with the peak memory the load allocates, reading
+the first page, decrypting passwords, adding, editing and deleting
+single entries, and building the Passwords page rows (when GTK is
+available). Per size, the AES-GCM fields are compared with the Fernet
+tokens they replaced, and sealing field by field with the batch calls.
+Syncing is timed against a local sync server, both the first sync and
+one after a few edits, along with the bytes each exchanged. On Linux, a
+memory profile reveals a number of passwords and then scans the process
+for copies of their plaintext: while they are cached, after
+forget_secrets(), and when decrypted to str and kept as the Passwords
+page used to. The results are written as JSON so runs can be compared to
+catch regressions.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from sync import SyncClient, make_server, sync_vault
+from vault import Vault
+
+# Single passwords decrypted per size for the latency percentiles
+DECRYPT_SAMPLES = 1000
+
+# Entries added, edited and deleted one at a time per size
+EDIT_SAMPLES = 100
+
+FIRST_PAGE_SIZE = 100
+
+# Entries of the vault the memory profile reveals passwords from
+SECRET_VAULT_SIZE = 2000
+
+# Passwords of that vault are SECRET_PREFIX and a 12 digit hex number, so
+# they are found without this process holding any of them; the pattern
+# does not match its own source
+SECRET_PREFIX = "sEcReT-"
+SECRET_PATTERN = re.compile(rb"sEcReT-([0-9a-f]{12})")
+SECRET_SIZE = len(SECRET_PREFIX) + 12
+
+# Bytes of memory scanned at a time
+SCAN_CHUNK_SIZE = 1024 * 1024
+
+
+def generate_rows(count):
+    return [(f"Account {number:06d}", f"https://site{number % 997}.example.com/login", f"pass-{number:06d}-word") for number in range(count)]
+
+
+def measure(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def measure_peak(func):
+    """Return the peak bytes Python allocated while ``func`` ran."""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[max(0, -(-percent * len(values) // 100) - 1)]
+
+
+def render_rows(passwords):
+    """Return the time to fill the Passwords page model, or None without GTK."""
+    try:
+        from main import COLUMN_ENTRY, PASSWORD_MASK, Gtk
+    except (ImportError, ValueError):
+        return None
+    store = Gtk.ListStore(str, str, str, object)
+    seconds, _ = measure(lambda: [store.append([password['name'], password['link'], PASSWORD_MASK, password]) for password in passwords])
+    assert len(store) == len(passwords) and store[0][COLUMN_ENTRY] is not None
+    return seconds
+
+
+def run(directory, backend, size):
+    path = os.path.join(directory, f"bench-{size}.{backend}")
+    key = AESGCM.generate_key(bit_length=256)
+    vault = Vault(key, path)
+    rows = generate_rows(size)
+
+    encrypt, passwords = measure(lambda: vault.encrypt_batch(rows))
+    with vault.lock, vault.storage.lock():
+        save, _ = measure(lambda: vault.save_passwords(passwords))
+
+    vault = Vault(key, path)
+    load, passwords = measure(vault.get_passwords)
+    # Separately, as tracing slows the load it measures
+    load_peak = measure_peak(lambda: Vault(key, path).get_passwords())
+    first_page, _ = measure(lambda: Vault(key, path).get_page(limit=FIRST_PAGE_SIZE))
+    decrypt_all, _ = measure(lambda: vault.decrypt_passwords(passwords))
+    decrypt_one = [measure(lambda: vault.decrypt_password(password))[0] for password in random.choices(passwords, k=DECRYPT_SAMPLES)]
+    search, _ = measure(lambda: vault.search("account 0001"))
+    render = render_rows(passwords)
+
+    # Each a separate write, as when entries are changed in the app
+    samples = min(EDIT_SAMPLES, size)
+    add, _ = measure(lambda: [vault.add(vault.new_entry(f"New {number}", "https://new.example.com", "new")) for number in range(samples)])
+    edited = random.sample(passwords, samples)
+    edit, _ = measure(lambda: [vault.replace(password['id'], vault.new_entry(password['name'], password['link'], "edited", password['id'])) for password in edited])
+    delete, _ = measure(lambda: [vault.remove(password['id']) for password in edited])
+
+    return {
+        'backend': backend,
+        'entries': size,
+        # SQLite keeps recent writes in its write-ahead log next to the file
+        'file_bytes': sum(os.path.getsize(name) for name in (path, path + "-wal") if os.path.exists(name)),
+        'encrypt_ms': round(encrypt * 1000, 3),
+        'save_ms': round(save * 1000, 3),
+        'load_ms': round(load * 1000, 3),
+        'load_peak_mb': round(load_peak / 2 ** 20, 1),
+        'first_page_ms': round(first_page * 1000, 3),
+        'decrypt_all_ms': round(decrypt_all * 1000, 3),
+        'decrypt_one_p50_us': round(percentile(decrypt_one, 50) * 1e6, 3),
+        'decrypt_one_p99_us': round(percentile(decrypt_one, 99) * 1e6, 3),
+        'search_ms': round(search * 1000, 3),
+        'add_ms_per_entry': round(add * 1000 / samples, 3),
+        'edit_ms_per_entry': round(edit * 1000 / samples, 3),
+        'delete_ms_per_entry': round(delete * 1000 / samples, 3),
+        'render_ms': round(render * 1000, 3) if render is not None else None,
+    }
+
+
+def run_ciphers(directory, size):
+    """Compare the AES-GCM fields of the vault with the older Fernet tokens,
+    and the per-field calls with the batch ones."""
+    key = AESGCM.generate_key(bit_length=256)
+    vault = Vault(key, os.path.join(directory, f"ciphers-{size}.csv"))
+    fernet = Fernet(Fernet.generate_key())
+    values = [password for _, _, password in generate_rows(size)]
+    items = [(str(number), "password", value) for number, value in enumerate(values)]
+
+    aesgcm_encrypt, tokens = measure(lambda: vault.encrypt_many(items))
+    aesgcm_decrypt, _ = measure(lambda: vault.decrypt_many([(password_id, field, token) for (password_id, field, _), token in zip(items, tokens)]))
+    item_encrypt, item_tokens = measure(lambda: [vault.encrypt_field(password_id, field, value) for password_id, field, value in items])
+    item_decrypt, _ = measure(lambda: [vault.decrypt_field(password_id, field, token) for (password_id, field, _), token in zip(items, item_tokens)])
+    fernet_encrypt, fernet_tokens = measure(lambda: [fernet.encrypt(value.encode()) for value in values])
+    fernet_decrypt, _ = measure(lambda: [fernet.decrypt(token) for token in fernet_tokens])
+
+    return {
+        'entries': size,
+        'aesgcm_encrypt_ms': round(aesgcm_encrypt * 1000, 3),
+        'aesgcm_decrypt_ms': round(aesgcm_decrypt * 1000, 3),
+        'aesgcm_token_bytes': round(sum(map(len, tokens)) / size, 1),
+        'per_item_encrypt_ms': round(item_encrypt * 1000, 3),
+        'per_item_decrypt_ms': round(item_decrypt * 1000, 3),
+        'fernet_encrypt_ms': round(fernet_encrypt * 1000, 3),
+        'fernet_decrypt_ms': round(fernet_decrypt * 1000, 3),
+        'fernet_token_bytes': round(sum(map(len, fernet_tokens)) / size, 1),
+    }
+
+
+def write_secret_vault(key, path):
+    # Runs in a child process, so no plaintext is ever made in the profiled one
+    vault = Vault(key, path)
+    with vault.lock, vault.storage.lock():
+        vault.save_passwords(vault.encrypt_batch([(f"Account {number:06d}", "https://example.com", f"{SECRET_PREFIX}{number:012x}") for number in range(SECRET_VAULT_SIZE)]))
+
+
+def scan_plaintexts():
+    """Return ``(passwords, copies)`` of the profile's plaintexts in writable memory,
+    or None where the process cannot read its own memory."""
+    found = {}
+    buffer = bytearray(SCAN_CHUNK_SIZE)
+    try:
+        with open("/proc/self/maps") as maps, open("/proc/self/mem", "rb", buffering=0) as mem:
+            for line in maps.readlines():
+                addresses, permissions = line.split()[:2]
+                if not permissions.startswith("rw"):
+                    continue
+                start, end = (int(address, 16) for address in addresses.split("-"))
+                # Chunks overlap by less than a match, so none is counted twice
+                for offset in range(start, end, SCAN_CHUNK_SIZE - SECRET_SIZE):
+                    # Wiped first, so the buffer never shows up in its own scan
+                    buffer[:] = bytes(SCAN_CHUNK_SIZE)
+                    try:
+                        mem.seek(offset)
+                        size = mem.readinto(memoryview(buffer)[:min(SCAN_CHUNK_SIZE, end - offset)])
+                    except (OSError, ValueError, OverflowError):
+                        break
+                    for match in SECRET_PATTERN.finditer(buffer, 0, size):
+                        number = int(match.group(1), 16)
+                        found[number] = found.get(number, 0) + 1
+    except OSError:
+        return None
+    finally:
+        buffer[:] = bytes(SCAN_CHUNK_SIZE)
+    return len(found), sum(found.values())
+
+
+def run_secrets(directory, reveals):
+    """Count the plaintext copies revealing ``reveals`` passwords leaves behind."""
+    path = os.path.join(directory, "secrets.csv")
+    key = AESGCM.generate_key(bit_length=256)
+    process = multiprocessing.get_context("spawn").Process(target=write_secret_vault, args=(key, path))
+    process.start()
+    process.join()
+
+    vault = Vault(key, path)
+    revealed = random.sample(vault.get_passwords(), min(reveals, SECRET_VAULT_SIZE))
+    scans = {'before': scan_plaintexts()}
+    if scans['before'] is None:
+        return None
+    for password in revealed:
+        # As the app and the command line use them
+        with vault.reveal_password(password) as secret:
+            len(secret.view())
+    scans['cached'] = scan_plaintexts()
+    vault.forget_secrets()
+    scans['forgotten'] = scan_plaintexts()
+    # As before: a str per password, kept alive by the page that showed it
+    # and never wiped
+    values = [vault.decrypt_password(password) for password in revealed]
+    scans['str'] = scan_plaintexts()
+    del values
+
+    result = {'entries': SECRET_VAULT_SIZE, 'revealed': len(revealed)}
+    for name, (passwords, copies) in scans.items():
+        result[f'{name}_passwords'] = passwords
+        result[f'{name}_copies'] = copies
+        result[f'{name}_bytes'] = copies * SECRET_SIZE
+    return result
+
+
+def run_sync(directory, backend, size, changes):
+    """Time two devices syncing a vault, then ``changes`` edits made on one."""
+    server = make_server(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    key = AESGCM.generate_key(bit_length=256)
+    first = Vault(key, os.path.join(directory, f"sync-{size}-1.{backend}"))
+    second = Vault(key, os.path.join(directory, f"sync-{size}-2.{backend}"))
+    with first.lock, first.storage.lock():
+        first.save_passwords(first.encrypt_batch(generate_rows(size)))
+
+    def sync(vault):
+        client = SyncClient(url)
+        seconds, _ = measure(lambda: sync_vault(vault, client))
+        return seconds, client.bytes_sent + client.bytes_received
+
+    upload, upload_bytes = sync(first)
+    download, download_bytes = sync(second)
+    for password in random.sample(first.get_passwords(), min(changes, size)):
+        first.replace(password['id'], first.new_entry(password['name'] + " (edited)", password['link'], "changed", password['id']))
+    push, push_bytes = sync(first)
+    pull, pull_bytes = sync(second)
+    idle, idle_bytes = sync(second)
+    server.shutdown()
+    server.server_close()
+
+    return {
+        'backend': backend,
+        'entries': size,
+        'changes': min(changes, size),
+        'first_upload_ms': round(upload * 1000, 3),
+        'first_upload_bytes': upload_bytes,
+        'first_download_ms': round(download * 1000, 3),
+        'first_download_bytes': download_bytes,
+        'push_ms': round(push * 1000, 3),
+        'push_bytes': push_bytes,
+        'pull_ms': round(pull * 1000, 3),
+        'pull_bytes': pull_bytes,
+        'idle_ms': round(idle * 1000, 3),
+        'idle_bytes': idle_bytes,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the vault on synthetic vaults")
+    parser.add_argument("--sizes", default="100,1000,10000,100000", help="comma separated entry counts (default: 100,1000,10000,100000)")
+    parser.add_argument("--backends", default="csv,db", help="comma separated file extensions (default: csv,db)")
+    parser.add_argument("--sync-changes", type=int, default=10, help="entries edited between two syncs (default: 10, 0 skips the sync benchmark)")
+    parser.add_argument("--secrets", type=int, default=200, help="passwords revealed for the memory profile (default: 200, 0 skips it)")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    results = []
+    cipher_results = []
+    sync_results = []
+    secret_result = None
+    with tempfile.TemporaryDirectory() as directory:
+        if args.secrets:
+            secret_result = run_secrets(directory, args.secrets)
+            if secret_result:
+                print(f"secrets: {secret_result['revealed']} revealed, plaintext copies cached {secret_result['cached_copies']}, "
+                      f"forgotten {secret_result['forgotten_copies']}, as str {secret_result['str_copies']}", file=sys.stderr)
+        for size in (int(size) for size in args.sizes.split(",")):
+            result = run_ciphers(directory, size)
+            print(f"    {size:>7}: encrypt AES-GCM {result['aesgcm_encrypt_ms']:.0f} ms batched, {result['per_item_encrypt_ms']:.0f} ms per item, Fernet {result['fernet_encrypt_ms']:.0f} ms", file=sys.stderr)
+            cipher_results.append(result)
+            for backend in args.backends.split(","):
+                result = run(directory, backend, size)
+                print(f"{backend:>3} {size:>7}: load {result['load_ms']:.0f} ms ({result['load_peak_mb']:.1f} MB peak), save {result['save_ms']:.0f} ms, "
+                      f"add/edit/delete {result['add_ms_per_entry']:.2f}/{result['edit_ms_per_entry']:.2f}/{result['delete_ms_per_entry']:.2f} ms", file=sys.stderr)
+                results.append(result)
+                if args.sync_changes:
+                    result = run_sync(directory, backend, size, args.sync_changes)
+                    print(f"{backend:>3} {size:>7}: sync of {result['changes']} changes {result['push_ms']:.0f} ms, {result['push_bytes']} bytes", file=sys.stderr)
+                    sync_results.append(result)
+
+    text = json.dumps({
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+        'ciphers': cipher_results,
+        'sync': sync_results,
+        'secrets': secret_result
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
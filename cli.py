@@ -0,0 +1,194 @@
+"""Command line interface to the password vault.
+
+Only imports the GTK-free vault module, so scripted and bulk operations
+start without initializing the GUI.
+
+    python cli.py list [--search TEXT]
+    python cli.py get NAME_OR_ID
+    python cli.py add NAME [--link LINK]
+    python cli.py delete ID
+    python cli.py import PATH
+    python cli.py export PATH
+    python cli.py rotate-key
+    python cli.py migrate passwords.db
+    python cli.py sync [URL]
+
+The vault is passwords.db if it exists, else passwords.csv, unless --vault
+says otherwise.
+
+The master password is read from the terminal, or from the
+MUX_MASTER_PASSWORD environment variable for unattended scripts.
+"""
+import argparse
+import getpass
+import os
+import sys
+import time
+
+from cryptography.fernet import InvalidToken
+
+from storage import KeyChanged
+from vault import default_vault_file, open_vault, read_header
+
+# Where sync.py listens unless told otherwise; not imported from there,
+# which pulls in the HTTP server for every command
+DEFAULT_SYNC_URL = "http://127.0.0.1:8765"
+
+
+def get_master_password(passwords_file):
+    master_password = os.environ.get("MUX_MASTER_PASSWORD")
+    if master_password:
+        return master_password
+
+    master_password = getpass.getpass("Master password: ")
+    if read_header(passwords_file) is None:
+        # The vault is protected with this password from now on
+        if not master_password or master_password != getpass.getpass("Repeat master password: "):
+            sys.exit("Master passwords do not match")
+    return master_password
+
+
+def find_passwords(vault, name_or_id):
+    password = vault.get(name_or_id)
+    if password is not None:
+        return [password]
+    return vault.find_by_name(name_or_id)
+
+
+def list_command(vault, args):
+    passwords = vault.get_passwords()
+    if args.search:
+        matches = vault.search(args.search)
+        passwords = [password for password in passwords if password['id'] in matches]
+    for password in passwords:
+        print(f"{password['id']}\t{password['name']}\t{password['link']}")
+
+
+def get_command(vault, args):
+    passwords = find_passwords(vault, args.name)
+    if not passwords:
+        sys.exit(f"No password found for '{args.name}'")
+    for password in passwords:
+        print(f"{password['name']}\t{password['link']}\t", end="", flush=True)
+        # Written from the wipeable buffer, never turned into a str
+        with vault.reveal_password(password) as secret:
+            sys.stdout.buffer.write(secret.view())
+        sys.stdout.buffer.write(b"\n")
+        sys.stdout.buffer.flush()
+    vault.forget_secrets()
+
+
+def add_command(vault, args):
+    password = getpass.getpass("Password: ")
+    if not password:
+        sys.exit("Password must not be empty")
+    entry = vault.new_entry(args.name, args.link, password)
+    vault.add(entry)
+    print(entry['id'])
+
+
+def delete_command(vault, args):
+    if vault.get(args.id) is None:
+        sys.exit(f"No password with id '{args.id}'")
+    vault.remove(args.id)
+
+
+def import_command(vault, args):
+    try:
+        try:
+            count, seconds = vault.import_passwords(args.path, args.master_password)
+        except InvalidToken:
+            # A backup made under another master password than this vault's
+            count, seconds = vault.import_passwords(args.path, getpass.getpass("Master password of the backup: "))
+    except InvalidToken:
+        sys.exit(f"Wrong master password for {args.path}")
+    except (OSError, ValueError) as error:
+        sys.exit(str(error))
+    print(f"Imported {count} passwords in {seconds:.2f}s")
+
+
+def export_command(vault, args):
+    count, seconds = vault.export_passwords(args.path)
+    print(f"Exported {count} passwords in {seconds:.2f}s")
+
+
+def rotate_key_command(vault, args):
+    try:
+        count, seconds = vault.rotate_key(args.master_password)
+    except (KeyChanged, ValueError) as error:
+        sys.exit(str(error))
+    print(f"Re-encrypted {count} records in {seconds:.2f}s")
+
+
+def migrate_command(vault, args):
+    count, seconds = vault.copy_to(args.target)
+    print(f"Copied {count} passwords to {args.target} in {seconds:.2f}s; {args.vault} is left as it was")
+
+
+def sync_command(vault, args):
+    from sync import SyncClient, SyncError, sync_vault
+
+    client = SyncClient(args.url)
+    start = time.perf_counter()
+    try:
+        sent, received = sync_vault(vault, client)
+    except SyncError as error:
+        sys.exit(str(error))
+    print(f"Sent {sent} and received {received} changes ({client.bytes_sent + client.bytes_received} bytes) in {time.perf_counter() - start:.2f}s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mux Password Manager command line")
+    parser.add_argument("--vault", default=default_vault_file(), help="password file, .csv or .db (default: passwords.db if it exists, else passwords.csv)")
+    parser.add_argument("--key", default="secret.key", help="key file of a vault without a master password yet (default: secret.key)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = commands.add_parser("list", help="list entries without decrypting them")
+    list_parser.add_argument("--search", help="only show entries whose name or link contains this")
+    list_parser.set_defaults(func=list_command)
+
+    get_parser = commands.add_parser("get", help="print the password of an entry")
+    get_parser.add_argument("name", help="entry id or name")
+    get_parser.set_defaults(func=get_command)
+
+    add_parser = commands.add_parser("add", help="add an entry, reading the password from the terminal")
+    add_parser.add_argument("name")
+    add_parser.add_argument("--link", default="")
+    add_parser.set_defaults(func=add_command)
+
+    delete_parser = commands.add_parser("delete", help="delete an entry by id")
+    delete_parser.add_argument("id")
+    delete_parser.set_defaults(func=delete_command)
+
+    import_parser = commands.add_parser("import", help="import a CSV export or an encrypted backup")
+    import_parser.add_argument("path")
+    import_parser.set_defaults(func=import_command)
+
+    export_parser = commands.add_parser("export", help="write an encrypted backup")
+    export_parser.add_argument("path")
+    export_parser.set_defaults(func=export_command)
+
+    rotate_parser = commands.add_parser("rotate-key", help="re-encrypt the vault under a new key, resuming an interrupted rotation")
+    rotate_parser.set_defaults(func=rotate_key_command)
+
+    sync_parser = commands.add_parser("sync", help="exchange changes with a sync server, e.g. one started with sync.py")
+    sync_parser.add_argument("url", nargs="?", default=DEFAULT_SYNC_URL, help=f"server address (default: {DEFAULT_SYNC_URL})")
+    sync_parser.set_defaults(func=sync_command)
+
+    migrate_parser = commands.add_parser("migrate", help="copy the vault into a new file, e.g. passwords.db to use SQLite")
+    migrate_parser.add_argument("target")
+    migrate_parser.set_defaults(func=migrate_command)
+
+    args = parser.parse_args(argv)
+    args.master_password = get_master_password(args.vault)
+    try:
+        vault = open_vault(args.master_password, args.vault, args.key)
+    except InvalidToken:
+        sys.exit("Wrong master password")
+    except FileNotFoundError as error:
+        sys.exit(str(error))
+    args.func(vault, args)
+
+
+if __name__ == "__main__":
+    main()
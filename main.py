@@ -1,9 +1,159 @@
 import gi
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, Gdk, GLib
-import os
 import datetime
-from cryptography.fernet import Fernet
+import logging
+import sys
+import time
+import math
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.fernet import InvalidToken
+from timing import record
+from vault import SECRET_CACHE_SECONDS, LoadCancelled, Secret, default_vault_file, open_vault, read_header
+
+logger = logging.getLogger(__name__)
+
+# Shown in place of every password so the list never has to decrypt anything
+PASSWORD_MASK = "*" * 8
+
+# Columns of the Passwords page list model
+COLUMN_NAME, COLUMN_LINK, COLUMN_MASK, COLUMN_ENTRY = range(4)
+
+# Entries shown before the rest of the vault has loaded, about a screenful
+FIRST_PAGE_SIZE = 100
+
+# Rows added to the Passwords list per idle callback
+ROW_CHUNK_SIZE = 1000
+
+# Page switches slower than this are reported as warnings, which show on
+# stderr without any logging setup
+SLOW_PAGE_SWITCH_SECONDS = 0.1
+
+
+class Job:
+    """Handle for work submitted to a WorkerPool.
+
+    Cancelling only stops results and progress from reaching the main loop;
+    work that checks ``report_progress`` also stops early.
+    """
+
+    def __init__(self, on_progress=None):
+        self.on_progress = on_progress
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def report_progress(self, fraction):
+        if self.cancelled:
+            return False
+        if self.on_progress:
+            GLib.idle_add(self.deliver_progress, fraction)
+        return True
+
+    def deliver_progress(self, fraction):
+        if not self.cancelled:
+            self.on_progress(fraction)
+        return False
+
+
+class WorkerPool:
+    """Runs blocking crypto and disk work off the GTK main loop.
+
+    ``func`` is called on a worker thread with its Job; ``on_done`` or
+    ``on_error`` is then called back on the main loop via GLib.idle_add,
+    unless the job was cancelled in the meantime.
+    """
+
+    def __init__(self, max_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="vault-worker")
+
+    def submit(self, func, on_done, on_error=None, on_progress=None):
+        job = Job(on_progress)
+        future = self.executor.submit(func, job)
+        future.add_done_callback(lambda future: GLib.idle_add(self.deliver, job, future, on_done, on_error))
+        return job
+
+    def deliver(self, job, future, on_done, on_error):
+        if job.cancelled:
+            # A revealed password that will never be shown is wiped here
+            if not future.cancelled() and future.exception() is None and isinstance(future.result(), Secret):
+                future.result().wipe()
+            return False
+        error = future.exception()
+        if error is None:
+            on_done(future.result())
+        elif not isinstance(error, LoadCancelled) and on_error:
+            on_error(error)
+        return False
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class Scheduler:
+    """Owns every GLib timeout and idle source of the window.
+
+    Sources are registered under a name, so scheduling a name again replaces
+    its old source instead of stacking another one. Page-scoped sources are
+    removed whenever the page changes.
+    """
+
+    def __init__(self):
+        self.sources = {}
+
+    def schedule(self, name, seconds, callback, repeat=False, page_scoped=False):
+        """Call ``callback`` after ``seconds``, or every ``seconds`` if ``repeat``.
+
+        A repeating callback can stop itself by returning False.
+        """
+        self.cancel(name)
+        source = {}
+
+        def fire():
+            keep = callback() is not False and repeat
+            # The callback may have rescheduled this name; leave that source alone
+            if not keep and self.sources.get(name, {}).get('id') == source['id']:
+                del self.sources[name]
+            return keep
+
+        source['id'] = GLib.timeout_add_seconds(seconds, fire)
+        source['page_scoped'] = page_scoped
+        self.sources[name] = source
+
+    def schedule_idle(self, name, callback, page_scoped=False):
+        """Call ``callback`` whenever the main loop is idle until it returns False.
+
+        Runs below redraw priority, so the window keeps painting and
+        handling input between calls.
+        """
+        self.cancel(name)
+        source = {}
+
+        def fire():
+            keep = callback() is not False
+            if not keep and self.sources.get(name, {}).get('id') == source['id']:
+                del self.sources[name]
+            return keep
+
+        source['id'] = GLib.idle_add(fire, priority=GLib.PRIORITY_DEFAULT_IDLE)
+        source['page_scoped'] = page_scoped
+        self.sources[name] = source
+
+    def cancel(self, name):
+        source = self.sources.pop(name, None)
+        if source:
+            GLib.source_remove(source['id'])
+
+    def cancel_page_sources(self):
+        for name, source in list(self.sources.items()):
+            if source['page_scoped']:
+                self.cancel(name)
+
+    def cancel_all(self):
+        for name in list(self.sources):
+            self.cancel(name)
+
 
 class PasswordManager(Gtk.Window):
     def __init__(self):
@@ -14,13 +164,20 @@ class PasswordManager(Gtk.Window):
         # Load and apply CSS
         self.apply_css()
 
-        # Initialize encryption key
-        self.key = self.load_or_generate_key()
-        self.fernet = Fernet(self.key)
+        # Unlock with the master password; passwords are then loaded once
+        # and kept in memory together with the key
+        self.vault = self.unlock_vault()
+
+        # Crypto and disk work runs here instead of in signal handlers
+        self.workers = WorkerPool()
+        self.page_jobs = []
+
+        # Every periodic or delayed callback goes through the scheduler
+        self.scheduler = Scheduler()
 
         # App lock variables
         self.lock_timeout = 60  # seconds
-        self.lock_timer = None
+        self.last_activity = time.monotonic()
         self.locked = False
         self.lock_pin = None  # Variable to store the lock PIN
 
@@ -56,8 +213,8 @@ class PasswordManager(Gtk.Window):
         self.create_menu_item("About", self.show_about_page)
         self.create_menu_item("Help", self.show_help_page)
 
-        # Create content area
-        self.content = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        # Create content area; each page is built once and kept in the stack
+        self.content = Gtk.Stack()
         self.content.get_style_context().add_class("content")
         self.paned.pack2(self.content, True, True)
 
@@ -67,6 +224,11 @@ class PasswordManager(Gtk.Window):
         # Start the lock timer
         self.start_lock_timer()
 
+        # Any input counts as activity for the idle lock
+        self.add_events(Gdk.EventMask.KEY_PRESS_MASK | Gdk.EventMask.BUTTON_PRESS_MASK | Gdk.EventMask.POINTER_MOTION_MASK)
+        for event in ("key-press-event", "button-press-event", "motion-notify-event"):
+            self.connect(event, self.on_user_activity)
+
         # Connect destroy event
         self.connect("destroy", self.on_destroy)
 
@@ -83,16 +245,47 @@ class PasswordManager(Gtk.Window):
         # Style for the main window
         self.get_style_context().add_class("main-window")
 
-    def load_or_generate_key(self):
-        key_file = "secret.key"
-        if os.path.exists(key_file):
-            with open(key_file, "rb") as f:
-                key = f.read()
-        else:
-            key = Fernet.generate_key()
-            with open(key_file, "wb") as f:
-                f.write(key)
-        return key
+    def unlock_vault(self):
+        vault_file = default_vault_file()
+        creating = read_header(vault_file) is None
+        while True:
+            dialog = Gtk.Dialog(title="Create Master Password" if creating else "Unlock Vault", transient_for=self, flags=0, buttons=(Gtk.STOCK_OK, Gtk.ResponseType.OK, Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL))
+            dialog.set_default_response(Gtk.ResponseType.OK)
+
+            password_label = Gtk.Label(label="Master password:")
+            password_entry = Gtk.Entry()
+            password_entry.set_visibility(False)
+            password_entry.set_activates_default(True)
+            dialog.vbox.pack_start(password_label, True, True, 0)
+            dialog.vbox.pack_start(password_entry, True, True, 0)
+
+            if creating:
+                repeat_label = Gtk.Label(label="Repeat master password:")
+                repeat_entry = Gtk.Entry()
+                repeat_entry.set_visibility(False)
+                repeat_entry.set_activates_default(True)
+                dialog.vbox.pack_start(repeat_label, True, True, 0)
+                dialog.vbox.pack_start(repeat_entry, True, True, 0)
+
+            dialog.show_all()
+            response = dialog.run()
+            master_password = password_entry.get_text()
+            repeated_password = repeat_entry.get_text() if creating else master_password
+            dialog.destroy()
+
+            if response != Gtk.ResponseType.OK:
+                sys.exit(0)
+            if not master_password or master_password != repeated_password:
+                self.show_message_dialog("Error", "Please enter the same master password twice.")
+                continue
+            try:
+                return open_vault(master_password, vault_file)
+            except InvalidToken:
+                self.show_message_dialog("Error", "Wrong master password. Please try again.")
+            except FileNotFoundError as error:
+                # An older vault whose key file is gone: no password can open it
+                self.show_message_dialog("Error", f"Cannot open the vault: {error}.")
+                sys.exit(1)
 
     def create_menu_item(self, label, callback):
         button = Gtk.Button(label=label)
@@ -103,6 +296,7 @@ class PasswordManager(Gtk.Window):
 
     def check_pin_required(self, callback):
         def wrapper(widget):
+            self.on_user_activity()
             if self.locked and self.lock_pin:
                 self.lock_app()
             else:
@@ -110,8 +304,13 @@ class PasswordManager(Gtk.Window):
         return wrapper
 
     def show_home_page(self, widget=None):
-        self.set_content("")
+        self.show_page("home", self.build_home_page)
+
+        # Clock display
+        self.update_clock()  # Initial update
+        self.scheduler.schedule("clock", 1, self.update_clock, repeat=True, page_scoped=True)  # Update every second
 
+    def build_home_page(self, page):
         # Welcome message
         welcome_label = Gtk.Label(label="<span font='x-large' weight='bold'>Welcome to Mux Password Manager</span>\n\n\n")
         welcome_label.set_use_markup(True)
@@ -120,9 +319,6 @@ class PasswordManager(Gtk.Window):
         # Clock display
         self.clock_label = Gtk.Label(label="")
         self.clock_label.set_use_markup(True)
-        self.update_clock()  # Initial update
-
-        GLib.timeout_add_seconds(1, self.update_clock)  # Update every second
 
         # Buttons
         see_passwords_button = Gtk.Button(label="See Passwords")
@@ -145,8 +341,7 @@ class PasswordManager(Gtk.Window):
         horizontal_alignment = Gtk.Alignment.new(0.5, 0.5, 0, 0)
         horizontal_alignment.add(vertical_box)
 
-        self.content.pack_start(horizontal_alignment, True, True, 0)
-        self.content.show_all()
+        page.pack_start(horizontal_alignment, True, True, 0)
 
     def update_clock(self):
         now = datetime.datetime.now()
@@ -159,79 +354,189 @@ class PasswordManager(Gtk.Window):
             self.lock_app()
             return
 
-        self.set_content("")
-
-    # Load passwords
-        passwords = self.load_passwords()
+        self.show_page("passwords", self.build_passwords_page)
+
+    # The first screenful is shown as soon as it is read; the whole vault
+    # then loads in the background and its rows are synced, not rebuilt
+        self.passwords_loading = True
+        self.passwords_page_start = time.perf_counter()
+        self.load_progress_bar.set_fraction(0)
+        self.load_progress_bar.set_text("Loading passwords...")
+        self.load_progress_bar.show()
+        # Without an indexed storage this is the whole load, so it reports
+        # progress and stops when the page is left
+        self.run_page_job(lambda job: self.vault.get_page(limit=FIRST_PAGE_SIZE, progress=job.report_progress)[0], self.on_first_page_loaded, self.update_load_progress)
+
+    def build_passwords_page(self, page):
+    # Single model holding every entry; the view only renders visible rows
+        self.passwords_store = Gtk.ListStore(str, str, str, object)
+        self.password_rows = {}
+        self.passwords_loading = False
+        self.search_job = None
+
+        # Rows are hidden by the filter rather than removed, so searching
+        # never rebuilds the model or any widgets
+        self.search_matches = None
+        self.passwords_filter = self.passwords_store.filter_new()
+        self.passwords_filter.set_visible_func(self.password_row_visible)
+
+        self.passwords_view = Gtk.TreeView(model=self.passwords_filter)
+        for title, column_id in (("Name", COLUMN_NAME), ("Link", COLUMN_LINK), ("Password", COLUMN_MASK)):
+            column = Gtk.TreeViewColumn(title, Gtk.CellRendererText(), text=column_id)
+            column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            column.set_fixed_width(250)
+            column.set_resizable(True)
+            self.passwords_view.append_column(column)
+        # Every row has the same height, so GTK can skip measuring off-screen rows
+        self.passwords_view.set_fixed_height_mode(True)
+        self.passwords_view.connect("row-activated", self.on_password_row_activated)
+
+    # Progress of loading the vault in the background
+        self.load_progress_bar = Gtk.ProgressBar()
+        self.load_progress_bar.set_show_text(True)
+        self.load_progress_bar.set_text("Loading passwords...")
+        page.pack_start(self.load_progress_bar, False, False, 0)
+
+    # Search by name or link as you type
+        self.search_entry = Gtk.SearchEntry()
+        self.search_entry.set_placeholder_text("Search by name or link")
+        self.search_entry.connect("search-changed", self.on_search_changed)
+        page.pack_start(self.search_entry, False, False, 0)
 
     # Scrolled window to contain passwords
         scrolled_window = Gtk.ScrolledWindow()
         scrolled_window.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
-        self.content.pack_start(scrolled_window, True, True, 0)
-
-    # Box for organizing passwords
-        passwords_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
-        scrolled_window.add(passwords_box)
-
-        for password in passwords:
-            name = password['name']
-            link = password['link']
-            encrypted_password = password['password']
-            decrypted_password = self.decrypt_password(encrypted_password)
-
-            # Password name
-            name_label = Gtk.Label(label=f"<span font='x-large' weight='bold'>Name:</span> {name}")
-            name_label.set_use_markup(True)
-            passwords_box.pack_start(name_label, False, False, 0)
-
-        # Link (if available)
-            if link:
-                link_label = Gtk.Label(label=f"<span font='x-large' weight='bold'>Link:</span> {link}")
-                link_label.set_use_markup(True)
-                passwords_box.pack_start(link_label, False, False, 0)
-
-        # Display password as asterisks by default
-            password_label = Gtk.Label(label=f"<span font='x-large' weight='bold'>Password:</span> {'*' * len(decrypted_password)}")
-            password_label.set_use_markup(True)
+        scrolled_window.add(self.passwords_view)
+        page.pack_start(scrolled_window, True, True, 0)
 
-        # Align password label to center
-            password_alignment = Gtk.Alignment.new(0.5, 0.5, 0, 0)
-            password_alignment.add(password_label)
-
-            passwords_box.pack_start(password_alignment, False, False, 0)
+    # Buttons acting on the selected row
+        buttons_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
 
-        # Buttons for operations
-            buttons_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
-        
-            show_button = Gtk.Button(label="Show")
-            edit_button = Gtk.Button(label="Edit")
-            delete_button = Gtk.Button(label="Delete")
+        show_button = Gtk.Button(label="Show")
+        edit_button = Gtk.Button(label="Edit")
+        delete_button = Gtk.Button(label="Delete")
 
-            show_button.connect("clicked", self.show_password_handler, decrypted_password)
-            edit_button.connect("clicked", self.edit_password, password)
-            delete_button.connect("clicked", self.delete_password, password)
+        show_button.connect("clicked", self.on_selected_password_action, self.show_password_handler)
+        edit_button.connect("clicked", self.on_selected_password_action, self.edit_password)
+        delete_button.connect("clicked", self.on_selected_password_action, self.delete_password)
 
-            buttons_box.pack_end(show_button, False, False, 0)
-            buttons_box.pack_end(edit_button, False, False, 0)
-            buttons_box.pack_end(delete_button, False, False, 0)
+        buttons_box.pack_end(show_button, False, False, 0)
+        buttons_box.pack_end(edit_button, False, False, 0)
+        buttons_box.pack_end(delete_button, False, False, 0)
 
-            passwords_box.pack_start(buttons_box, False, False, 0)
+        page.pack_start(buttons_box, False, False, 0)
 
-            # Horizontal separator
-            separator = Gtk.Separator(orientation=Gtk.Orientation.HORIZONTAL)
-            passwords_box.pack_start(separator, False, False, 5)
+    def update_load_progress(self, fraction):
+        self.load_progress_bar.set_fraction(fraction)
 
-        self.content.show_all()
+    def on_first_page_loaded(self, passwords):
+        # The first page is a prefix of the full list, so its rows already
+        # sit where the full sync expects them
+        for password in passwords:
+            self.sync_password_row(password)
+        elapsed = time.perf_counter() - self.passwords_page_start
+        record("ui.passwords_first_page", elapsed)
+        logger.debug("First passwords shown after %.2f ms", elapsed * 1000)
+        self.run_page_job(lambda job: self.vault.get_passwords(job.report_progress), self.on_passwords_loaded, self.update_load_progress)
+
+    def on_passwords_loaded(self, passwords):
+        # Rows are synced a chunk per idle callback, so a large vault
+        # streams into the list while the window stays responsive
+        rows = self.sync_password_rows(passwords)
+        self.scheduler.schedule_idle("password-rows", lambda: next(rows, False) is None, page_scoped=True)
+
+    def sync_password_rows(self, passwords):
+        """Sync the list with ``passwords``, yielding after every chunk of rows.
+
+        Only rows that changed since the last visit are touched.
+        """
+        self.load_progress_bar.set_text("Showing passwords...")
+        current_ids = set()
+        for count, password in enumerate(passwords, 1):
+            current_ids.add(password['id'])
+            self.sync_password_row(password)
+            if count % ROW_CHUNK_SIZE == 0:
+                self.load_progress_bar.set_fraction(count / len(passwords))
+                yield
+        for password_id in set(self.password_rows) - current_ids:
+            self.passwords_store.remove(self.password_rows.pop(password_id))
+
+        self.passwords_loading = False
+        self.on_search_changed(self.search_entry)
+        self.load_progress_bar.hide()
+        elapsed = time.perf_counter() - self.passwords_page_start
+        record("ui.passwords_page", elapsed)
+        logger.debug("All %d passwords shown after %.2f ms", len(passwords), elapsed * 1000)
+
+    def sync_password_row(self, password):
+        tree_iter = self.password_rows.get(password['id'])
+        if tree_iter is None:
+            self.password_rows[password['id']] = self.passwords_store.append(
+                [password['name'], password['link'], PASSWORD_MASK, password])
+        elif self.passwords_store[tree_iter][COLUMN_ENTRY] != password:
+            self.passwords_store[tree_iter] = [password['name'], password['link'], PASSWORD_MASK, password]
+
+    def get_selected_password(self):
+        model, tree_iter = self.passwords_view.get_selection().get_selected()
+        if tree_iter is None:
+            return None
+        return model[tree_iter][COLUMN_ENTRY]
+
+    def on_selected_password_action(self, widget, action):
+        password_info = self.get_selected_password()
+        if password_info is None:
+            self.show_message_dialog("Information", "Please select a password first.")
+            return
+        action(widget, password_info)
 
+    def on_password_row_activated(self, tree_view, path, column):
+        self.show_password_handler(tree_view, tree_view.get_model()[path][COLUMN_ENTRY])
 
-    def show_password_handler(self, widget, decrypted_password):
-        dialog = Gtk.MessageDialog(
-            parent=self,
-            flags=0,
-            message_type=Gtk.MessageType.INFO,
-            buttons=Gtk.ButtonsType.OK,
-            text=f"Password: {decrypted_password}"
-        )
+    def on_search_changed(self, search_entry):
+        if self.passwords_loading:
+            # Searching needs the whole vault; the query is applied once
+            # the list is complete
+            return
+        if self.search_job:
+            self.search_job.cancel()
+            self.search_job = None
+        query = search_entry.get_text().strip()
+        if not query:
+            self.on_search_done(None)
+            return
+        # The lookup waits for the vault lock, which a load or write on a
+        # worker may hold, so it never runs on the main loop
+        self.search_job = self.run_page_job(lambda job: self.vault.search(query), self.on_search_done)
+
+    def on_search_done(self, matches):
+        self.search_matches = matches
+        self.passwords_filter.refilter()
+
+    def password_row_visible(self, model, tree_iter, data):
+        if self.search_matches is None:
+            return True
+        return model[tree_iter][COLUMN_ENTRY]['id'] in self.search_matches
+
+    def show_password_handler(self, widget, password_info):
+        self.on_secret_revealed()
+        self.run_page_job(lambda job: self.vault.reveal_password(password_info), self.show_decrypted_password)
+
+    def on_secret_revealed(self):
+        # The vault's cache of revealed passwords is wiped once none was
+        # revealed for a while, and whenever the app locks. Scheduled when
+        # the reveal is asked for, so it runs even if the page is left
+        # before the password is shown
+        self.scheduler.schedule("secrets", SECRET_CACHE_SECONDS, self.vault.forget_secrets)
+
+    def show_decrypted_password(self, secret):
+        with secret:
+            dialog = Gtk.MessageDialog(
+                parent=self,
+                flags=0,
+                message_type=Gtk.MessageType.INFO,
+                buttons=Gtk.ButtonsType.OK,
+                text=f"Password: {secret.text()}"
+            )
         dialog.set_title("Decrypted Password")
         dialog.run()
         dialog.destroy()
@@ -241,8 +546,9 @@ class PasswordManager(Gtk.Window):
             self.lock_app()
             return
 
-        self.set_content("")
+        self.show_page("add", self.build_add_a_password_page)
 
+    def build_add_a_password_page(self, page):
         # Labels and entry fields
         name_label = Gtk.Label(label="Name:")
         self.name_entry = Gtk.Entry()
@@ -271,8 +577,7 @@ class PasswordManager(Gtk.Window):
         add_password_alignment = Gtk.Alignment.new(0.5, 0.5, 0, 0)
         add_password_alignment.add(add_password_box)
 
-        self.content.pack_start(add_password_alignment, True, True, 0)
-        self.content.show_all()
+        page.pack_start(add_password_alignment, True, True, 0)
 
     def add_password(self, widget):
         name = self.name_entry.get_text()
@@ -283,13 +588,12 @@ class PasswordManager(Gtk.Window):
             self.show_message_dialog("Error", "Please enter name and password.")
             return
 
-        encrypted_password = self.encrypt_password(password)
-        new_password = {'name': name, 'link': link, 'password': encrypted_password}
+        def add_job(job):
+            self.vault.add(self.vault.new_entry(name, link, password))
 
-        passwords = self.load_passwords()
-        passwords.append(new_password)
-        self.save_passwords(passwords)
+        self.workers.submit(add_job, self.on_password_added, self.on_job_failed)
 
+    def on_password_added(self, result):
         self.show_message_dialog("Success", "Password added successfully.")
 
         # Clear entries
@@ -298,34 +602,122 @@ class PasswordManager(Gtk.Window):
         self.password_entry.set_text("")
 
     def show_settings_page(self, widget=None):
-        self.set_content("")
+        self.show_page("settings", self.build_settings_page)
+        # The page is kept between visits; a PIN typed earlier must not be
+        self.pin_entry.set_text("")
 
+    def build_settings_page(self, page):
         # Page title
         title_label = Gtk.Label(label="<span font='x-large' weight='bold'>Settings</span>")
         title_label.set_use_markup(True)
 
         # Form elements for PIN
         pin_label = Gtk.Label(label="Enter 4-digit PIN:")
-        pin_entry = Gtk.Entry()
-        pin_entry.set_visibility(False)
-        pin_entry.set_max_length(4)
+        self.pin_entry = Gtk.Entry()
+        self.pin_entry.set_visibility(False)
+        self.pin_entry.set_max_length(4)
 
         save_button = Gtk.Button(label="Save PIN")
-        save_button.connect("clicked", self.save_pin, pin_entry)
+        save_button.connect("clicked", self.save_pin, self.pin_entry)
+
+        # Bulk import and encrypted backup
+        import_button = Gtk.Button(label="Import Passwords...")
+        import_button.connect("clicked", self.on_import_clicked)
+
+        export_button = Gtk.Button(label="Export Encrypted Backup...")
+        export_button.connect("clicked", self.on_export_clicked)
+
+        rotate_button = Gtk.Button(label="Rotate Vault Key...")
+        rotate_button.connect("clicked", self.on_rotate_key_clicked)
 
         # Vertical box for form
         form_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
         form_box.pack_start(title_label, False, False, 0)
         form_box.pack_start(pin_label, False, False, 0)
-        form_box.pack_start(pin_entry, False, False, 0)
+        form_box.pack_start(self.pin_entry, False, False, 0)
         form_box.pack_start(save_button, False, False, 0)
+        form_box.pack_start(import_button, False, False, 0)
+        form_box.pack_start(export_button, False, False, 0)
+        form_box.pack_start(rotate_button, False, False, 0)
 
         # Center align form box
         form_alignment = Gtk.Alignment.new(0.5, 0.5, 0, 0)
         form_alignment.add(form_box)
 
-        self.content.pack_start(form_alignment, True, True, 0)
-        self.content.show_all()
+        page.pack_start(form_alignment, True, True, 0)
+
+    def choose_file(self, title, action, button):
+        dialog = Gtk.FileChooserDialog(title=title, transient_for=self, action=action)
+        dialog.add_buttons(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL, button, Gtk.ResponseType.OK)
+        if action == Gtk.FileChooserAction.SAVE:
+            dialog.set_do_overwrite_confirmation(True)
+        response = dialog.run()
+        path = dialog.get_filename() if response == Gtk.ResponseType.OK else None
+        dialog.destroy()
+        return path
+
+    def on_import_clicked(self, widget):
+        path = self.choose_file("Import Passwords", Gtk.FileChooserAction.OPEN, Gtk.STOCK_OPEN)
+        if not path:
+            return
+        master_password = None
+        try:
+            needs_password = self.vault.backup_needs_password(path)
+        except (OSError, ValueError) as error:
+            self.on_job_failed(error)
+            return
+        if needs_password:
+            # A backup of another vault, or of this one before a key rotation
+            master_password = self.ask_master_password("Restore Backup", "Master password of the backup:")
+            if master_password is None:
+                return
+        self.workers.submit(lambda job: self.vault.import_passwords(path, master_password), self.on_bulk_finished("Imported"), self.on_import_failed)
+
+    def on_import_failed(self, error):
+        if isinstance(error, InvalidToken):
+            self.show_message_dialog("Error", "Wrong master password for this backup. Nothing was imported.")
+        else:
+            self.on_job_failed(error)
+
+    def on_export_clicked(self, widget):
+        path = self.choose_file("Export Encrypted Backup", Gtk.FileChooserAction.SAVE, Gtk.STOCK_SAVE)
+        if path:
+            self.workers.submit(lambda job: self.vault.export_passwords(path), self.on_bulk_finished("Exported"), self.on_job_failed)
+
+    def ask_master_password(self, title, label="Master password:"):
+        """Ask for a master password; returns None if the dialog is cancelled."""
+        dialog = Gtk.Dialog(title=title, transient_for=self, flags=0, buttons=(Gtk.STOCK_OK, Gtk.ResponseType.OK, Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL))
+        dialog.set_default_response(Gtk.ResponseType.OK)
+        password_label = Gtk.Label(label=label)
+        password_entry = Gtk.Entry()
+        password_entry.set_visibility(False)
+        password_entry.set_activates_default(True)
+        dialog.vbox.pack_start(password_label, True, True, 0)
+        dialog.vbox.pack_start(password_entry, True, True, 0)
+        dialog.show_all()
+        response = dialog.run()
+        master_password = password_entry.get_text()
+        dialog.destroy()
+        return master_password if response == Gtk.ResponseType.OK else None
+
+    def on_rotate_key_clicked(self, widget):
+        master_password = self.ask_master_password("Rotate Vault Key")
+        if master_password is not None:
+            # Not a page job: leaving the page must not interrupt the rotation
+            self.workers.submit(lambda job: self.vault.rotate_key(master_password), self.on_bulk_finished("Re-encrypted"), self.on_rotate_key_failed)
+
+    def on_rotate_key_failed(self, error):
+        if isinstance(error, InvalidToken):
+            self.show_message_dialog("Error", "Wrong master password. The vault key was not changed.")
+        else:
+            self.on_job_failed(error)
+
+    def on_bulk_finished(self, verb):
+        def on_done(result):
+            count, seconds = result
+            rate = count / seconds if seconds else 0
+            self.show_message_dialog("Success", f"{verb} {count} passwords ({rate:.0f} entries/s).")
+        return on_done
 
     def toggle_pin_enabled(self, checkbox):
         if checkbox.get_active():
@@ -338,6 +730,7 @@ class PasswordManager(Gtk.Window):
 
     def save_pin(self, widget, pin_entry):
         pin = pin_entry.get_text()
+        pin_entry.set_text("")
         if len(pin) == 4 and pin.isdigit():
             self.lock_pin = pin
             dialog = Gtk.MessageDialog(
@@ -367,8 +760,9 @@ class PasswordManager(Gtk.Window):
         self.show_message_dialog("Success", "Settings reset successfully.")
 
     def show_about_page(self, widget=None):
-        self.set_content("")
+        self.show_page("about", self.build_about_page)
 
+    def build_about_page(self, page):
         about_label = Gtk.Label(label="""
         <span font='x-large' weight='bold' foreground='#00afef'>Mux Password Manager</span>\n
         <span font='large'>Version: 1.0</span>\n
@@ -380,12 +774,12 @@ class PasswordManager(Gtk.Window):
         about_label.set_use_markup(True)
         about_label.set_justify(Gtk.Justification.CENTER)
 
-        self.content.pack_start(about_label, True, True, 0)
-        self.content.show_all()
+        page.pack_start(about_label, True, True, 0)
 
     def show_help_page(self, widget=None):
-        self.set_content("")
+        self.show_page("help", self.build_help_page)
 
+    def build_help_page(self, page):
         help_label = Gtk.Label(label="<span font='x-large' weight='bold'>Help - Mux Password Manager</span>\n\n"
                                       "<b>Home:</b>\n"
                                       "Displays a welcome message and the current time. You can navigate to the passwords page or add a new password from here.\n\n"
@@ -403,67 +797,129 @@ class PasswordManager(Gtk.Window):
         help_label.set_use_markup(True)
         help_label.set_justify(Gtk.Justification.CENTER)
 
-        self.content.pack_start(help_label, True, True, 0)
-        self.content.show_all()
-
-    def set_content(self, content):
-        self.content.foreach(lambda widget: self.content.remove(widget))
-        if content:
-            self.content.add(Gtk.Label(label=content))
-        self.content.show_all()
+        page.pack_start(help_label, True, True, 0)
+
+    def run_page_job(self, func, on_done, on_progress=None):
+        # Page jobs are cancelled as soon as the user navigates elsewhere
+        job = self.workers.submit(func, on_done, self.on_job_failed, on_progress)
+        self.page_jobs.append(job)
+        return job
+
+    def on_job_failed(self, error):
+        self.show_message_dialog("Error", f"Operation failed: {str(error) or type(error).__name__}")
+
+    def show_page(self, name, build_page=None):
+        """Switch the content stack to ``name``, building the page on first use.
+
+        Work and timers started by the previous page are stopped first.
+        Every switch time is recorded for MUX_TIMING (see timing.py), and
+        a slow switch is also logged as a warning.
+        """
+        start = time.perf_counter()
+        for job in self.page_jobs:
+            job.cancel()
+        self.page_jobs = []
+        self.scheduler.cancel_page_sources()
+
+        if self.content.get_child_by_name(name) is None:
+            page = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+            if build_page:
+                build_page(page)
+            page.show_all()
+            self.content.add_named(page, name)
+        self.content.set_visible_child_name(name)
+
+        elapsed = time.perf_counter() - start
+        record(f"ui.show_page.{name}", elapsed)
+        if elapsed > SLOW_PAGE_SWITCH_SECONDS:
+            logger.warning("Switching to the %s page took %.0f ms", name, elapsed * 1000)
+        else:
+            logger.debug("Switched to %s page in %.2f ms", name, elapsed * 1000)
 
     def lock_app(self):
-        self.set_content("")
+        self.scheduler.cancel("lock")
+        self.scheduler.cancel("secrets")
+        self.vault.forget_secrets()
+        if not self.lock_pin:
+            # Without a PIN there is nothing to unlock with: passwords are
+            # hidden by going home and the idle lock is armed again
+            self.show_home_page()
+            self.start_lock_timer()
+            return
+        self.show_page("locked", self.build_locked_page)
+        self.unlock_entry.set_text("")
+        self.unlock_entry.grab_focus()
         self.show_message_dialog("Locked", "Application locked. Enter PIN to unlock.")
-        self.unlock_timer = None
         self.locked = True
 
+    def build_locked_page(self, page):
+        locked_label = Gtk.Label(label="<span font='x-large' weight='bold'>Locked</span>")
+        locked_label.set_use_markup(True)
+
+        self.unlock_entry = Gtk.Entry()
+        self.unlock_entry.set_visibility(False)
+        self.unlock_entry.set_max_length(4)
+        self.unlock_entry.set_placeholder_text("PIN")
+
+        unlock_button = Gtk.Button(label="Unlock")
+        unlock_button.connect("clicked", self.on_unlock_clicked)
+        self.unlock_entry.connect("activate", self.on_unlock_clicked)
+
+        unlock_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
+        unlock_box.pack_start(locked_label, False, False, 0)
+        unlock_box.pack_start(self.unlock_entry, False, False, 0)
+        unlock_box.pack_start(unlock_button, False, False, 0)
+
+        unlock_alignment = Gtk.Alignment.new(0.5, 0.5, 0, 0)
+        unlock_alignment.add(unlock_box)
+        page.pack_start(unlock_alignment, True, True, 0)
+
+    def on_unlock_clicked(self, widget):
+        pin = self.unlock_entry.get_text()
+        self.unlock_entry.set_text("")
+        self.unlock_app(pin)
+
     def start_lock_timer(self):
         if self.lock_timeout > 0:
-            self.lock_timer = GLib.timeout_add_seconds(self.lock_timeout, self.lock_app)
+            self.last_activity = time.monotonic()
+            self.scheduler.schedule("lock", self.lock_timeout, self.check_idle_lock)
+
+    def on_user_activity(self, *args):
+        # Only a timestamp is updated here; the single lock source checks it
+        # when it fires instead of being re-armed on every event
+        self.last_activity = time.monotonic()
+        return False
+
+    def check_idle_lock(self):
+        idle = time.monotonic() - self.last_activity
+        if idle >= self.lock_timeout:
+            self.lock_app()
+        else:
+            self.scheduler.schedule("lock", math.ceil(self.lock_timeout - idle), self.check_idle_lock)
 
     def unlock_app(self, pin):
         if pin == self.lock_pin:
             self.locked = False
             self.start_lock_timer()
+            self.show_home_page()
             self.show_message_dialog("App Unlocked", "The application is unlocked.")
         else:
             self.show_message_dialog("Invalid PIN", "Invalid PIN. Please try again.")
 
     def on_destroy(self, *args):
+        self.scheduler.cancel_all()
+        self.workers.shutdown()
+        self.vault.forget_secrets()
         Gtk.main_quit()
 
-    def encrypt_password(self, password):
-        return self.fernet.encrypt(password.encode())
-
-    def decrypt_password(self, encrypted_password):
-        return self.fernet.decrypt(encrypted_password).decode()
-
-    def load_passwords(self):
-        passwords_file = "passwords.csv"
-        passwords = []
-        if os.path.exists(passwords_file):
-            with open(passwords_file, "r") as f:
-                lines = f.readlines()
-                for line in lines:
-                    name, link, encrypted_password = line.strip().split(",")
-                    passwords.append({
-                        'name': name,
-                        'link': link,
-                        'password': encrypted_password.encode()
-                    })
-        return passwords
-
-    def save_passwords(self, passwords):
-        passwords_file = "passwords.csv"
-        with open(passwords_file, "w") as f:
-            for password in passwords:
-                name = password['name']
-                link = password['link']
-                encrypted_password = password['password'].decode()
-                f.write(f"{name},{link},{encrypted_password}\n")
-
     def edit_password(self, widget, password_info):
+        self.on_secret_revealed()
+        self.run_page_job(
+            lambda job: self.vault.reveal_password(password_info),
+            lambda secret: self.show_edit_dialog(password_info, secret)
+        )
+
+    def show_edit_dialog(self, password_info, secret):
         dialog = Gtk.Dialog(title="Edit Password", transient_for=self, flags=0, buttons=(Gtk.STOCK_OK, Gtk.ResponseType.OK, Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL))
 
         name_label = Gtk.Label(label="Name:")
@@ -480,7 +936,8 @@ class PasswordManager(Gtk.Window):
 
         password_label = Gtk.Label(label="Password:")
         password_entry = Gtk.Entry()
-        password_entry.set_text(self.decrypt_password(password_info["password"]))
+        with secret:
+            password_entry.set_text(secret.text())
         password_entry.set_visibility(False)  # Hide password input
         dialog.vbox.pack_start(password_label, True, True, 0)
         dialog.vbox.pack_start(password_entry, True, True, 0)
@@ -494,20 +951,11 @@ class PasswordManager(Gtk.Window):
             new_password = password_entry.get_text()
 
             if new_name != password_info["name"] or new_link != password_info["link"] or new_password:
-                encrypted_password = self.encrypt_password(new_password)
-                updated_password = {
-                    "name": new_name,
-                    "link": new_link,
-                    "password": encrypted_password
-                }
-
-                passwords = self.load_passwords()
-                index = passwords.index(password_info)
-                passwords[index] = updated_password
-                self.save_passwords(passwords)
-
-                self.show_message_dialog("Success", "Password updated successfully.")
-                self.show_passwords_page()
+                def edit_job(job):
+                    updated_password = self.vault.new_entry(new_name, new_link, new_password, password_info['id'])
+                    self.vault.replace(password_info['id'], updated_password)
+
+                self.workers.submit(edit_job, self.on_password_edited, self.on_job_failed)
             else:
                 self.show_message_dialog("Information", "No changes made.")
         dialog.destroy()
@@ -524,13 +972,17 @@ class PasswordManager(Gtk.Window):
 
         response = dialog.run()
         if response == Gtk.ResponseType.YES:
-            passwords = self.load_passwords()
-            passwords.remove(password_info)
-            self.save_passwords(passwords)
-            self.show_message_dialog("Success", "Password deleted successfully.")
-            self.show_passwords_page()
+            self.workers.submit(lambda job: self.vault.remove(password_info['id']), self.on_password_deleted, self.on_job_failed)
         dialog.destroy()
 
+    def on_password_edited(self, result):
+        self.show_message_dialog("Success", "Password updated successfully.")
+        self.show_passwords_page()
+
+    def on_password_deleted(self, result):
+        self.show_message_dialog("Success", "Password deleted successfully.")
+        self.show_passwords_page()
+
     def show_message_dialog(self, title, message):
         dialog = Gtk.MessageDialog(
             parent=self,
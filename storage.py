@@ -0,0 +1,767 @@
+"""Storage backends of the password vault.
+
+A storage only ever sees sealed rows ``(id, name, link, password,
+name_hash)``, already encrypted by the Vault, and never keys or
+plaintext. Two backends share one interface:
+
+CsvStorage      passwords.csv, an append-only log (the default)
+SqliteStorage   an SQLite database in WAL mode, for large vaults with
+                frequent edits
+
+Reading: ``lock(shared=True)`` pins a consistent view, ``changed()`` tells
+whether another instance wrote since the last ``mark_synced()``, and
+``read_records()`` yields ``(records, fraction)`` batches of ``(id,
+fields, position)``, where ``fields`` are the sealed name, link and
+password or None for a deleted entry. With ``since_sync`` only the
+changes after the last sync are read, which ``can_replay()`` says is
+possible.
+
+Writing: ``add()``, ``update()``, ``delete()`` and ``save()`` must run
+under ``lock()`` after the caller caught up with ``changed()``.
+``rotate()`` re-encrypts the whole store through a callback, resumably.
+
+Storages with ``indexed`` set also answer ``read_ids()``,
+``read_name_hash()`` and ``read_page()`` without a full read.
+open_storage() picks a backend from the file extension.
+"""
+import os
+import contextlib
+import csv
+import itertools
+import json
+import logging
+import sqlite3
+import threading
+try:
+    import fcntl
+except ImportError:  # Windows: instances are not locked against each other
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Markers of the edit and delete records appended to passwords.csv
+EDIT_RECORD = "~"
+DELETE_RECORD = "-"
+
+# Start of the first line of passwords.csv, followed by the header as JSON
+VAULT_HEADER = "#MUXVAULT "
+
+# Rows re-encrypted per step of a key rotation
+ROTATE_BATCH_SIZE = 500
+
+# File extensions stored in SQLite rather than CSV
+SQLITE_EXTENSIONS = (".db", ".sqlite", ".sqlite3")
+
+# Seconds an SQLite write waits for another instance's transaction
+SQLITE_TIMEOUT = 30
+
+# Revisions of changed ids kept for other instances to catch up from
+CHANGE_LOG_SIZE = 10000
+
+
+class LoadCancelled(Exception):
+    """Raised when a progress callback asks to stop loading the vault."""
+
+
+class KeyChanged(Exception):
+    """Raised when another instance rotated the vault key since it was unlocked."""
+
+    def __init__(self):
+        super().__init__("The vault key was changed by another instance. Unlock the vault again.")
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def replace_file(temp_file, path):
+    """Atomically move the fsync'd ``temp_file`` over ``path``.
+
+    The directory is synced too, otherwise a crash right after the rename
+    can still bring back the old file.
+    """
+    os.replace(temp_file, path)
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def read_header_line(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        line = f.readline()
+    if not line.startswith(VAULT_HEADER):
+        return None
+    return json.loads(line[len(VAULT_HEADER):])
+
+
+def check_header(stored_header, header):
+    """Raise KeyChanged if ``stored_header`` no longer wraps the key of ``header``."""
+    if header and stored_header and stored_header['key'] != header['key']:
+        raise KeyChanged()
+
+
+def open_storage(path, header=None, compact_threshold=64 * 1024):
+    if path.endswith(SQLITE_EXTENSIONS):
+        return SqliteStorage(path, header)
+    return CsvStorage(path, header, compact_threshold)
+
+
+class CsvStorage:
+    """passwords.csv as an append-only log.
+
+    A snapshot of plain ``id,name,link,password`` rows is followed by the
+    records written since the last compaction. Every add, edit and delete
+    appends one small fsync'd record, and once the edit/delete records pass
+    ``compact_threshold`` bytes a background thread folds the log back into
+    a plain snapshot. The header is kept as the file's first line.
+
+    Instances write under an fcntl lock on ``<file>.lock``. When another
+    instance only appended to the log, just the new records are read back.
+    """
+
+    indexed = False
+
+    def __init__(self, path, header=None, compact_threshold=64 * 1024):
+        self.path = path
+        self.header = header
+        self.compact_threshold = compact_threshold
+        # (stat signature, last bytes) of the file the reader caught up with
+        self.synced = None
+        # Bytes of edit/delete records that a compaction would drop
+        self.journal_size = 0
+        # Lines in the file as of the last read or write, for numbering
+        # appended ones
+        self.line_count = 0
+        self.corrupt_lines = []
+        self.compacting = False
+        # Serializes this instance's threads; the file lock covers others
+        self.mutex = threading.RLock()
+        # Open while this instance holds the advisory lock on the vault
+        self.lock_file = None
+
+    def read_header(self):
+        return read_header_line(self.path)
+
+    def exists(self):
+        return os.path.exists(self.path) and os.path.getsize(self.path) > 0
+
+    def get_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        # The inode changes when another instance swaps in a snapshot
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def read_tail(self, signature, size=64):
+        if signature is None:
+            return b""
+        with open(self.path, "rb") as f:
+            f.seek(max(signature[2] - size, 0))
+            return f.read(min(signature[2], size))
+
+    @contextlib.contextmanager
+    def lock(self, shared=False):
+        """Hold the advisory lock every instance of this vault writes under.
+
+        The lock is taken on a separate ``.lock`` file, since passwords.csv
+        itself is replaced on every compaction. Nested calls reuse the lock
+        already held.
+        """
+        with self.mutex:
+            if fcntl is None or self.lock_file is not None:
+                yield
+                return
+            with open(self.path + ".lock", "a") as f:
+                fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+                self.lock_file = f
+                try:
+                    yield
+                finally:
+                    # Closing the file releases the lock
+                    self.lock_file = None
+
+    def changed(self):
+        return self.synced is None or self.get_signature() != self.synced[0]
+
+    def snapshot(self):
+        signature = self.get_signature()
+        return signature, self.read_tail(signature)
+
+    def mark_synced(self, snapshot):
+        self.synced = snapshot
+
+    def can_replay(self, snapshot):
+        # Snapshots are always swapped in as a new file, but inode numbers
+        # get reused, so the bytes that used to end the file are compared as
+        # well; they end in a random nonce and only match the same log
+        if self.synced is None or self.synced[0] is None or snapshot[0] is None:
+            return False
+        old, new = self.synced[0], snapshot[0]
+        return new[0] == old[0] and new[2] > old[2] and self.read_tail(old) == self.synced[1]
+
+    def read_records(self, batch_size, since_sync=False, legacy=False):
+        offset = self.synced[0][2] if since_sync else 0
+        if not since_sync:
+            self.journal_size = 0
+            self.corrupt_lines = []
+        total_size = max(os.path.getsize(self.path) - offset, 1) if os.path.exists(self.path) else 1
+        read_size = 0
+        for lines in batched(self.read_lines(offset, legacy), batch_size):
+            records = []
+            for password_id, fields, journal_bytes, line_size, line_number in lines:
+                self.journal_size += journal_bytes
+                read_size += line_size
+                records.append((password_id, fields, line_number))
+            yield records, read_size / total_size
+
+    def read_lines(self, offset=0, legacy=False):
+        """Yield ``(id, fields, journal_bytes, line_size, line_number)`` per record.
+
+        Reading starts at byte ``offset``, which must be the start of a
+        line. With ``legacy``, rows written before ids existed are accepted
+        too. The file is streamed a line at a time through the csv module.
+        Lines that cannot be parsed are logged and skipped instead of
+        aborting the load.
+        """
+        if not os.path.exists(self.path):
+            return
+        first_line = self.line_count + 1 if offset else 1
+        line_number = first_line - 1
+        with open(self.path, "r", newline="") as f:
+            f.seek(offset)
+            # Each line is parsed on its own, so a torn or mangled quote can
+            # only ever cost that line and not every record appended after it
+            for line_number, line in enumerate(f, first_line):
+                if line_number == 1 and line.startswith(VAULT_HEADER):
+                    continue
+                try:
+                    if '"' in line:
+                        fields = next(csv.reader([line], strict=True), [])
+                    else:
+                        # Unquoted rows, i.e. nearly all of them, split the same way
+                        fields = line.rstrip("\r\n").split(",") if line.strip() else []
+                except csv.Error as e:
+                    self.report_corrupt_line(line_number, e)
+                    continue
+
+                if not fields:
+                    continue
+                journal_bytes = 0
+                if fields[0] == EDIT_RECORD and len(fields) == 5:
+                    password_id, name, link, encrypted_password = fields[1:]
+                    journal_bytes = sum(len(field) + 1 for field in fields)
+                elif fields[0] == DELETE_RECORD and len(fields) == 2:
+                    yield fields[1], None, sum(len(field) + 1 for field in fields), len(line), line_number
+                    continue
+                elif len(fields) == 3 and legacy:
+                    # Rows written before ids existed get one from their
+                    # position, which stays fixed until the next compaction
+                    password_id = str(line_number - 1)
+                    name, link, encrypted_password = fields
+                elif len(fields) == 4:
+                    password_id, name, link, encrypted_password = fields
+                else:
+                    self.report_corrupt_line(line_number, f"unexpected {len(fields)} fields")
+                    continue
+
+                yield password_id, (name, link, encrypted_password), journal_bytes, len(line), line_number
+        self.line_count = line_number
+
+    def report_corrupt_line(self, line_number, reason):
+        self.corrupt_lines.append(line_number)
+        logger.warning("Skipping corrupt line %d in %s: %s", line_number, self.path, reason)
+
+    def write_header(self, f, header):
+        if header:
+            f.write(VAULT_HEADER + json.dumps(header) + "\n")
+
+    def add(self, rows):
+        self.append_records([row[:4] for row in rows], False)
+
+    def update(self, rows):
+        self.append_records([[EDIT_RECORD, *row[:4]] for row in rows], True)
+
+    def delete(self, password_ids):
+        self.append_records([[DELETE_RECORD, password_id] for password_id in password_ids], True)
+
+    def ends_with_newline(self):
+        with open(self.path, "rb") as f:
+            if f.seek(0, os.SEEK_END) == 0:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def append_records(self, rows, is_journal):
+        new_file = not os.path.exists(self.path)
+        torn = not new_file and not self.ends_with_newline()
+        with open(self.path, "a", newline="") as f:
+            if new_file:
+                self.write_header(f, self.header)
+            elif torn:
+                # A crash cut the last append short; start a fresh line so
+                # only that record is lost rather than this one as well
+                f.write("\n")
+            csv.writer(f, lineterminator="\n").writerows(rows)
+            self.line_count += int(bool(new_file and self.header)) + len(rows)
+            f.flush()
+            os.fsync(f.fileno())
+        self.synced = self.snapshot()
+
+        if is_journal:
+            self.journal_size += sum(len(field) + 1 for row in rows for field in row)
+            if self.journal_size > self.compact_threshold and not self.compacting:
+                self.compacting = True
+                threading.Thread(target=self.compact, daemon=True).start()
+
+    def save(self, rows):
+        """Replace the whole log with a snapshot of ``rows``."""
+        self.write_snapshot(row[:4] for row in rows)
+
+    def write_snapshot(self, rows):
+        # Write a fresh snapshot next to the log and swap it in atomically,
+        # so a crash leaves either the old log or the new snapshot
+        temp_file = self.path + ".tmp"
+        with open(temp_file, "w", newline="") as f:
+            self.write_header(f, self.header)
+            writer = csv.writer(f, lineterminator="\n")
+            line_count = int(bool(self.header))
+            for chunk in batched(rows, ROTATE_BATCH_SIZE):
+                writer.writerows(chunk)
+                line_count += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(temp_file, self.path)
+        self.synced = self.snapshot()
+        self.line_count = line_count
+        self.journal_size = 0
+
+    def compact(self):
+        # Folding needs no keys: the surviving sealed rows are copied as is
+        try:
+            with self.lock():
+                caught_up = not self.changed()
+                rows = {}
+                for password_id, fields, *_ in self.read_lines():
+                    if fields is None:
+                        rows.pop(password_id, None)
+                    else:
+                        rows[password_id] = fields
+                synced = self.synced
+                self.write_snapshot([password_id, *fields] for password_id, fields in rows.items())
+                if not caught_up:
+                    # Leave the records another instance wrote for the reader
+                    self.synced = synced
+        finally:
+            self.compacting = False
+
+    def pending_rotation(self):
+        """Return the header of an interrupted rotation that can resume, if any."""
+        temp_file = self.path + ".rotate"
+        if self.read_checkpoint(temp_file + ".json", self.get_signature()):
+            return read_header_line(temp_file)
+        return None
+
+    def rotate(self, old_header, header, reseal, progress=None):
+        """Rewrite the log with every record passed through ``reseal``.
+
+        The log is streamed record by record into ``<file>.rotate``, a batch
+        at a time, so memory stays bounded by the batch size rather than the
+        vault size; the new file is renamed over the old one only once it is
+        complete. After every fsync'd batch a checkpoint is written, and a
+        rotation to the same ``header`` that was interrupted or cancelled
+        (``progress`` returned False) resumes from it, as long as the log
+        itself has not changed since.
+
+        ``reseal`` takes a list of ``(id, fields)`` and returns a sealed row
+        or None for each. Edit and delete records stay journal records, so
+        nothing has to be folded in memory. Returns the number of records.
+
+        Raises KeyChanged if the log is no longer sealed under the key of
+        ``old_header``, and ValueError if a record cannot be decrypted; the
+        vault is left as it was either way.
+        """
+        temp_file = self.path + ".rotate"
+        checkpoint_file = temp_file + ".json"
+        with self.lock():
+            stored_header = self.read_header()
+            if stored_header == header:
+                # Another instance resumed this same rotation and finished it
+                self.header = header
+                self.synced = None
+                return 0
+            # Checked under the lock, so no rotation can slip in before ours
+            check_header(stored_header, old_header)
+            signature = self.get_signature()
+            checkpoint = self.read_checkpoint(checkpoint_file, signature)
+            if checkpoint and read_header_line(temp_file) != header:
+                checkpoint = None
+            count = checkpoint['records'] if checkpoint else 0
+            if checkpoint:
+                logger.info("Resuming key rotation of %s after %d records", self.path, count)
+
+            total_size = max(signature[2], 1) if signature else 1
+            read_size = 0
+            lines = self.read_lines()
+            with open(temp_file, "r+" if checkpoint else "w", newline="") as f:
+                if checkpoint:
+                    # Drops anything written after the last checkpoint
+                    f.truncate(checkpoint['offset'])
+                    f.seek(checkpoint['offset'])
+                    read_size = sum(line[3] for line in itertools.islice(lines, count))
+                else:
+                    self.write_header(f, header)
+                writer = csv.writer(f, lineterminator="\n")
+                for batch in batched(lines, ROTATE_BATCH_SIZE):
+                    writer.writerows(self.rotate_lines(batch, reseal))
+                    f.flush()
+                    os.fsync(f.fileno())
+                    count += len(batch)
+                    read_size += sum(line[3] for line in batch)
+                    self.write_checkpoint(checkpoint_file, {'signature': signature, 'records': count, 'offset': f.tell()})
+                    if progress and progress(read_size / total_size) is False:
+                        raise LoadCancelled()
+
+            replace_file(temp_file, self.path)
+            os.remove(checkpoint_file)
+            self.header = header
+            self.synced = None
+        return count
+
+    def rotate_lines(self, lines, reseal):
+        sealed = iter(reseal([(line[0], line[1]) for line in lines if line[1] is not None]))
+        rows = []
+        for password_id, fields, journal_bytes, _, line_number in lines:
+            if fields is None:
+                rows.append([DELETE_RECORD, password_id])
+                continue
+            row = next(sealed)
+            if row is None:
+                # Dropping it would lose the entry for good
+                raise ValueError(f"Line {line_number} of {self.path} cannot be decrypted, the key was not rotated")
+            rows.append([EDIT_RECORD, *row[:4]] if journal_bytes else list(row[:4]))
+        return rows
+
+    def read_checkpoint(self, checkpoint_file, signature):
+        try:
+            with open(checkpoint_file, "r") as f:
+                checkpoint = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if checkpoint['signature'] != list(signature or ()):
+            # The vault changed since, so the rotated records are stale
+            logger.info("Discarding stale key rotation checkpoint %s", checkpoint_file)
+            return None
+        return checkpoint
+
+    def write_checkpoint(self, checkpoint_file, checkpoint):
+        temp_file = checkpoint_file + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(temp_file, checkpoint_file)
+
+
+class SqliteStorage:
+    """An SQLite database in WAL mode.
+
+    Every entry is one row, so edits and deletes are single-row updates
+    and nothing ever needs compacting. Rows are indexed by a keyed hash of
+    the normalized name and read in pages in insertion order, so lookups
+    and the first screen of the list never need the whole vault.
+
+    Every write transaction bumps a revision in the meta table and logs the
+    ids it touched, which is how other instances catch up with only the
+    rows that changed. SQLite's own locking keeps instances apart.
+    """
+
+    indexed = True
+
+    def __init__(self, path, header=None):
+        self.path = path
+        self.header = header
+        self.connection = None
+        # Revision the reader caught up with
+        self.synced = None
+        self.corrupt_lines = []
+        # Serializes this instance's threads on the shared connection
+        self.mutex = threading.RLock()
+        # Nesting of lock() on this instance
+        self.depth = 0
+
+    def connect(self):
+        if self.connection is None:
+            # Transactions are issued explicitly by lock()
+            connection = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Commits are fsync'd, like every write to passwords.csv
+            connection.execute("PRAGMA synchronous=FULL")
+            connection.executescript("""
+                BEGIN IMMEDIATE;
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+                CREATE TABLE IF NOT EXISTS passwords (
+                    seq INTEGER PRIMARY KEY,
+                    id TEXT NOT NULL UNIQUE,
+                    name TEXT NOT NULL,
+                    link TEXT NOT NULL,
+                    password TEXT NOT NULL,
+                    name_hash TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS passwords_name_hash ON passwords (name_hash);
+                CREATE TABLE IF NOT EXISTS changes (revision INTEGER NOT NULL, id TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS changes_revision ON changes (revision);
+                CREATE TABLE IF NOT EXISTS rotation AS SELECT * FROM passwords WHERE 0;
+                INSERT OR IGNORE INTO meta VALUES ('revision', 0), ('base_revision', 0);
+                COMMIT;
+            """)
+            if self.header:
+                connection.execute("INSERT OR IGNORE INTO meta VALUES ('header', ?)", (json.dumps(self.header),))
+            self.connection = connection
+        return self.connection
+
+    def get_meta(self, key):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def read_header(self):
+        if not os.path.exists(self.path):
+            return None
+        with self.lock(shared=True):
+            header = self.get_meta('header')
+        return json.loads(header) if header else None
+
+    def exists(self):
+        if not os.path.exists(self.path):
+            return False
+        with self.lock(shared=True):
+            return self.connection.execute("SELECT 1 FROM passwords LIMIT 1").fetchone() is not None
+
+    @contextlib.contextmanager
+    def lock(self, shared=False):
+        """Run the block in one transaction, a write transaction unless ``shared``.
+
+        Nested calls join the transaction already open.
+        """
+        with self.mutex:
+            if self.depth:
+                self.depth += 1
+                try:
+                    yield
+                finally:
+                    self.depth -= 1
+                return
+            connection = self.connect()
+            connection.execute("BEGIN" if shared else "BEGIN IMMEDIATE")
+            self.depth = 1
+            try:
+                yield
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            else:
+                connection.execute("COMMIT")
+            finally:
+                self.depth = 0
+
+    def changed(self):
+        with self.lock(shared=True):
+            return self.synced is None or self.snapshot() != self.synced
+
+    def snapshot(self):
+        return self.get_meta('revision')
+
+    def mark_synced(self, snapshot):
+        self.synced = snapshot
+
+    def can_replay(self, snapshot):
+        return self.synced is not None and self.synced >= self.get_meta('base_revision')
+
+    def read_records(self, batch_size, since_sync=False, legacy=False):
+        if since_sync:
+            ids = [row[0] for row in self.connection.execute("SELECT DISTINCT id FROM changes WHERE revision > ?", (self.synced,))]
+            for start in range(0, len(ids), batch_size):
+                batch = ids[start:start + batch_size]
+                records = {record[0]: record for record in self.read_ids(batch)}
+                # Ids that are gone were deleted
+                yield [records.get(password_id, (password_id, None, None)) for password_id in batch], (start + len(batch)) / len(ids)
+            return
+
+        self.corrupt_lines = []
+        total = max(self.connection.execute("SELECT count(*) FROM passwords").fetchone()[0], 1)
+        cursor = self.connection.execute("SELECT id, name, link, password, seq FROM passwords ORDER BY seq")
+        count = 0
+        while rows := cursor.fetchmany(batch_size):
+            count += len(rows)
+            yield self.to_records(rows), count / total
+
+    def to_records(self, rows):
+        return [(password_id, (name, link, password), seq) for password_id, name, link, password, seq in rows]
+
+    def read_ids(self, password_ids):
+        with self.lock(shared=True):
+            placeholders = ",".join("?" * len(password_ids))
+            rows = self.connection.execute(
+                f"SELECT id, name, link, password, seq FROM passwords WHERE id IN ({placeholders}) ORDER BY seq", list(password_ids)
+            ).fetchall()
+        return self.to_records(rows)
+
+    def read_name_hash(self, name_hash):
+        with self.lock(shared=True):
+            rows = self.connection.execute(
+                "SELECT id, name, link, password, seq FROM passwords WHERE name_hash = ? ORDER BY seq", (name_hash,)
+            ).fetchall()
+        return self.to_records(rows)
+
+    def read_page(self, after, limit):
+        """Return up to ``limit`` records after cursor ``after`` and the next cursor.
+
+        The next cursor is None once the last page was read.
+        """
+        with self.lock(shared=True):
+            rows = self.connection.execute(
+                "SELECT id, name, link, password, seq FROM passwords WHERE seq > ? ORDER BY seq LIMIT ?", (after or 0, limit)
+            ).fetchall()
+        return self.to_records(rows), rows[-1][4] if len(rows) == limit else None
+
+    def report_corrupt_line(self, seq, reason):
+        self.corrupt_lines.append(seq)
+        logger.warning("Skipping corrupt row %s in %s: %s", seq, self.path, reason)
+
+    def add(self, rows):
+        rows = [tuple(row) for row in rows]
+        self.connection.executemany("INSERT INTO passwords (id, name, link, password, name_hash) VALUES (?, ?, ?, ?, ?)", rows)
+        self.record_changes([row[0] for row in rows])
+
+    def update(self, rows):
+        rows = [tuple(row) for row in rows]
+        self.connection.executemany(
+            "INSERT INTO passwords (id, name, link, password, name_hash) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET name = excluded.name, link = excluded.link, "
+            "password = excluded.password, name_hash = excluded.name_hash",
+            rows
+        )
+        self.record_changes([row[0] for row in rows])
+
+    def delete(self, password_ids):
+        password_ids = list(password_ids)
+        self.connection.executemany("DELETE FROM passwords WHERE id = ?", ((password_id,) for password_id in password_ids))
+        self.record_changes(password_ids)
+
+    def save(self, rows):
+        """Replace every row with ``rows``."""
+        self.connection.execute("DELETE FROM passwords")
+        self.connection.executemany("INSERT INTO passwords (id, name, link, password, name_hash) VALUES (?, ?, ?, ?, ?)", (tuple(row) for row in rows))
+        self.record_changes(None)
+
+    def record_changes(self, password_ids):
+        """Bump the revision and log ``password_ids``; None means everything changed."""
+        revision = self.get_meta('revision') + 1
+        self.set_meta('revision', revision)
+        if password_ids is None or len(password_ids) > CHANGE_LOG_SIZE:
+            # Cheaper for other instances to reload than to replay this
+            self.connection.execute("DELETE FROM changes")
+            self.set_meta('base_revision', revision)
+        else:
+            self.connection.executemany("INSERT INTO changes VALUES (?, ?)", ((revision, password_id) for password_id in password_ids))
+            if revision % 1000 == 0 and revision > CHANGE_LOG_SIZE:
+                self.connection.execute("DELETE FROM changes WHERE revision <= ?", (revision - CHANGE_LOG_SIZE,))
+                self.set_meta('base_revision', max(self.get_meta('base_revision'), revision - CHANGE_LOG_SIZE))
+        self.synced = revision
+
+    def pending_rotation(self):
+        """Return the header of an interrupted rotation that can resume, if any."""
+        if not os.path.exists(self.path):
+            return None
+        with self.lock(shared=True):
+            rotation = self.get_meta('rotation')
+            rotation = json.loads(rotation) if rotation else None
+            if rotation and rotation['revision'] == self.get_meta('revision'):
+                return rotation['header']
+        return None
+
+    def rotate(self, old_header, header, reseal, progress=None):
+        """Rewrite every row through ``reseal`` and store ``header``.
+
+        Rows are resealed into a shadow table in batches, each committed
+        together with its checkpoint, so memory stays bounded and an
+        interrupted rotation to the same ``header`` resumes where it
+        stopped. The rows are swapped in with one final transaction. A
+        write by another instance in between restarts the rotation, as the
+        rows copied so far are stale, and another instance rotating to the
+        same ``header`` shares the work.
+
+        Every batch first checks that the rows are still sealed under the
+        key of ``old_header``, and raises KeyChanged if another instance
+        rotated them or started a rotation to another key. A row that
+        cannot be decrypted raises ValueError. Either way the vault is left
+        as it was. Returns the number of rows.
+        """
+        rotation = None
+        while True:
+            with self.lock():
+                stored_header = json.loads(self.get_meta('header') or "null")
+                if stored_header == header:
+                    # Another instance doing this same rotation swapped it in
+                    break
+                check_header(stored_header, old_header)
+                revision = self.get_meta('revision')
+                stored = self.get_meta('rotation')
+                stored = json.loads(stored) if stored else None
+                if stored and stored['header'] == header and stored['revision'] == revision:
+                    if rotation is None:
+                        logger.info("Resuming key rotation of %s after %d rows", self.path, stored['records'])
+                    # Also picks up the batches another instance added
+                    rotation = stored
+                elif rotation is not None and rotation['revision'] == revision:
+                    # Our checkpoint was replaced by a rotation to another key
+                    raise KeyChanged()
+                else:
+                    self.connection.execute("DELETE FROM rotation")
+                    rotation = {'header': header, 'revision': revision, 'seq': 0, 'records': 0}
+
+                rows = self.connection.execute(
+                    "SELECT id, name, link, password, seq FROM passwords WHERE seq > ? ORDER BY seq LIMIT ?",
+                    (rotation['seq'], ROTATE_BATCH_SIZE)
+                ).fetchall()
+                if not rows:
+                    self.connection.execute("DELETE FROM passwords")
+                    self.connection.execute("INSERT INTO passwords SELECT * FROM rotation")
+                    self.connection.execute("DELETE FROM rotation")
+                    self.connection.execute("DELETE FROM meta WHERE key = 'rotation'")
+                    self.set_meta('header', json.dumps(header))
+                    self.record_changes(None)
+                    break
+
+                records = self.to_records(rows)
+                sealed = reseal([(password_id, fields) for password_id, fields, _ in records])
+                for (_, _, seq), row in zip(records, sealed):
+                    if row is None:
+                        # Dropping it would lose the entry for good
+                        raise ValueError(f"Row {seq} of {self.path} cannot be decrypted, the key was not rotated")
+                    self.connection.execute("INSERT INTO rotation VALUES (?, ?, ?, ?, ?, ?)", (seq, *row))
+                rotation['seq'] = rows[-1][4]
+                rotation['records'] += len(rows)
+                self.set_meta('rotation', json.dumps(rotation))
+
+            total = max(self.count(), 1)
+            if progress and progress(min(rotation['records'] / total, 1)) is False:
+                raise LoadCancelled()
+
+        self.header = header
+        self.synced = None
+        return rotation['records'] if rotation else 0
+
+    def count(self):
+        with self.lock(shared=True):
+            return self.connection.execute("SELECT count(*) FROM passwords").fetchone()[0]
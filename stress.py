@@ -0,0 +1,148 @@
+"""Stress the vault with several processes writing to it at once.
+
+    python stress.py [--writers 6] [--entries 120] [--rotators 3] [--backends csv,db]
+
+Every writer process opens its own Vault on one shared file and adds
+entries, editing every third and deleting every fifth as it goes, with
+compaction forced often. Afterwards the file is read back in a fresh
+instance and compared with what the writers left: any lost, extra or
+corrupt entry is reported and the script exits with status 1.
+
+Then several processes rotate the key of one vault at the same time,
+each pausing between batches so the rotations overlap. A rotation may
+fail because another one won, but the vault must still open with every
+entry under whichever key was stored last.
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from storage import ROTATE_BATCH_SIZE, KeyChanged
+from vault import Vault, open_vault
+
+# Small enough that the writers keep compacting under each other
+STRESS_COMPACT_THRESHOLD = 4096
+
+STRESS_MASTER_PASSWORD = "stress"
+
+# Key rotations each rotator process attempts
+ROTATE_ROUNDS = 3
+
+# Seconds a rotator waits between batches, for others to run in between
+ROTATE_PAUSE = 0.05
+
+
+def write_entries(key, path, writer, count):
+    vault = Vault(key, path, compact_threshold=STRESS_COMPACT_THRESHOLD)
+    ids = []
+    for number in range(count):
+        password = vault.new_entry(f"writer{writer}-{number}", "https://example.com", f"pass{writer}-{number}")
+        vault.add(password)
+        ids.append(password['id'])
+        if number % 3 == 0:
+            vault.replace(ids[number], vault.new_entry(f"writer{writer}-{number}-edited", "https://example.com", "edited", ids[number]))
+        if number % 5 == 0 and number:
+            vault.remove(ids[number - 1])
+    # A compaction may still be running in the background
+    while getattr(vault.storage, "compacting", False):
+        time.sleep(0.01)
+
+
+def rotate_keys(path):
+    rotated = 0
+    for _ in range(ROTATE_ROUNDS):
+        vault = open_vault(STRESS_MASTER_PASSWORD, path)
+        try:
+            vault.rotate_key(STRESS_MASTER_PASSWORD, lambda fraction: time.sleep(ROTATE_PAUSE))
+            rotated += 1
+        except KeyChanged:
+            # Another rotator got there first; unlock again and retry
+            pass
+    print(f"  rotator {os.getpid()}: {rotated} of {ROTATE_ROUNDS} rotations done")
+
+
+def expected_names(writers, count):
+    names = set()
+    for writer in range(writers):
+        for number in range(count):
+            if number % 5 == 4 and number + 1 < count:
+                # Deleted by the next step
+                continue
+            names.add(f"writer{writer}-{number}-edited" if number % 3 == 0 else f"writer{writer}-{number}")
+    return names
+
+
+def run(directory, backend, writers, count):
+    path = os.path.join(directory, f"stress.{backend}")
+    key = AESGCM.generate_key(bit_length=256)
+    # Spawned so every writer starts from a clean interpreter like a real instance
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=write_entries, args=(key, path, writer, count)) for writer in range(writers)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    seconds = time.perf_counter() - start
+
+    vault = Vault(key, path)
+    names = {password['name'] for password in vault.get_passwords()}
+    expected = expected_names(writers, count)
+    corrupt = len(getattr(vault.storage, "corrupt_lines", ()))
+    failed_writers = sum(process.exitcode != 0 for process in processes)
+    print(f"{backend:>3}: {writers} writers x {count}: {len(names)} entries, expected {len(expected)}, "
+          f"lost {len(expected - names)}, extra {len(names - expected)}, corrupt {corrupt}, "
+          f"failed writers {failed_writers}, {writers * count / seconds:.0f} adds/s")
+    return names == expected and not corrupt and not failed_writers
+
+
+def run_rotations(directory, backend, rotators):
+    path = os.path.join(directory, f"rotate.{backend}")
+    vault = open_vault(STRESS_MASTER_PASSWORD, path)
+    # Several batches, so other rotations can run between them
+    count = ROTATE_BATCH_SIZE * 2 + ROTATE_BATCH_SIZE // 2
+    vault.add_many(vault.encrypt_batch([(f"rotate-{number}", "https://example.com", f"pass-{number}") for number in range(count)]))
+
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=rotate_keys, args=(path,)) for _ in range(rotators)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    seconds = time.perf_counter() - start
+
+    vault = open_vault(STRESS_MASTER_PASSWORD, path)
+    passwords = vault.get_passwords()
+    intact = sum(value == f"pass-{password['name'][len('rotate-'):]}" for password, value in zip(passwords, vault.decrypt_passwords(passwords)))
+    corrupt = len(getattr(vault.storage, "corrupt_lines", ()))
+    failed_rotators = sum(process.exitcode != 0 for process in processes)
+    print(f"{backend:>3}: {rotators} rotators x {ROTATE_ROUNDS}: {intact} of {count} entries intact, corrupt {corrupt}, "
+          f"failed rotators {failed_rotators}, {seconds:.1f}s")
+    return intact == len(passwords) == count and not corrupt and not failed_rotators
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stress the vault with concurrent writer processes")
+    parser.add_argument("--writers", type=int, default=6, help="writer processes (default: 6)")
+    parser.add_argument("--entries", type=int, default=120, help="entries added by each writer (default: 120)")
+    parser.add_argument("--rotators", type=int, default=3, help="processes rotating the key at once (default: 3, 0 skips)")
+    parser.add_argument("--backends", default="csv,db", help="comma separated file extensions (default: csv,db)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = [run(directory, backend, args.writers, args.entries) for backend in args.backends.split(",")]
+        if args.rotators:
+            results += [run_rotations(directory, backend, args.rotators) for backend in args.backends.split(",")]
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
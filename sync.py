@@ -0,0 +1,344 @@
+"""Delta synchronization of a vault between machines through a sync server.
+
+Every entry has a version ``(clock, device)``: a Lamport clock and the id
+of the device that last changed it. A sync sends only the entries changed
+here since the last sync, each under a version newer than any this device
+has seen, and receives what other devices changed in the meantime, all in
+one request. The server and every device keep the entry with the highest
+version, so conflicting edits resolve the same way everywhere: the later
+clock wins, then the larger device id.
+
+Changes made here are found by comparing each entry's entry_digest() with
+the one recorded at the last sync in ``<vault file>.sync``, so edits by
+any instance of the app or the command line are picked up.
+
+The server only ever sees sealed fields and an id of the data key, under
+which it keeps each vault apart. SyncServer is a reference server for
+testing on one machine:
+
+    python sync.py [--host 127.0.0.1] [--port 8765] [--data FILE]
+"""
+
+import argparse
+import contextlib
+import http.server
+import json
+import logging
+import os
+import threading
+import urllib.request
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows: syncs of one vault are not locked against each other
+    fcntl = None
+
+from storage import replace_file
+
+logger = logging.getLogger(__name__)
+
+SYNC_HOST = "127.0.0.1"
+SYNC_PORT = 8765
+
+# Seconds to wait for the server before a sync fails
+SYNC_TIMEOUT = 30
+
+# Kept next to the vault file, e.g. passwords.csv.sync
+SYNC_STATE_EXTENSION = ".sync"
+
+
+class SyncError(Exception):
+    """The sync server could not be reached or refused the request."""
+
+
+class SyncState:
+    """What this device knew after its last sync.
+
+    ``entries`` maps every synced id to ``[clock, device, digest]``: the
+    version of the entry and its entry_digest(), None once deleted.
+    ``server`` and ``revision`` tell which server was synced with and how
+    far, so only later changes are asked for.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.device = uuid.uuid4().hex
+        self.clock = 0
+        self.server = None
+        self.revision = 0
+        self.entries = {}
+
+    @classmethod
+    def load(cls, path):
+        state = cls(path)
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            state.device = data['device']
+            state.clock = data['clock']
+            state.server = data['server']
+            state.revision = data['revision']
+            state.entries = data['entries']
+        return state
+
+    def save(self):
+        temp_file = self.path + ".tmp"
+        with open(temp_file, "w") as f:
+            # dumps() rather than dump(), which encodes in pure Python
+            f.write(json.dumps({
+                'device': self.device,
+                'clock': self.clock,
+                'server': self.server,
+                'revision': self.revision,
+                'entries': self.entries
+            }, separators=(",", ":")))
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(temp_file, self.path)
+
+    def version(self, password_id, digest):
+        """Return the version to send an entry under, a new one if it changed here."""
+        entry = self.entries.get(password_id)
+        if entry is not None and entry[2] == digest:
+            return entry[:2]
+        self.clock += 1
+        return [self.clock, self.device]
+
+
+class SyncClient:
+    """Sends sync requests to a server over HTTP, counting the bytes exchanged."""
+
+    def __init__(self, url, timeout=SYNC_TIMEOUT):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def exchange(self, request):
+        body = json.dumps(request, separators=(",", ":")).encode()
+        http_request = urllib.request.Request(self.url + "/sync", data=body, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(http_request, timeout=self.timeout) as response:
+                data = response.read()
+        except OSError as error:
+            raise SyncError(f"Cannot sync with {self.url}: {error}") from error
+        self.bytes_sent += len(body)
+        self.bytes_received += len(data)
+        return json.loads(data)
+
+
+@contextlib.contextmanager
+def locked(path):
+    # Two syncs of one vault at once would both send the same changes
+    if fcntl is None:
+        yield
+        return
+    with open(path + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def sync_vault(vault, client):
+    """Exchange the changes since the last sync with the server behind ``client``.
+
+    Returns the number of entries sent and the number received and applied.
+    Raises SyncError if the server cannot be reached.
+    """
+    state_path = vault.passwords_file + SYNC_STATE_EXTENSION
+    with locked(state_path):
+        state = SyncState.load(state_path)
+        position = (state.server, state.revision, state.clock)
+        result = exchange_changes(vault, client, state)
+        if result is None:
+            # A different server, or one that lost its data
+            logger.warning("Sync server changed, sending the whole vault again")
+            result = exchange_changes(vault, client, state, resend=True)
+        if any(result) or (state.server, state.revision, state.clock) != position or not os.path.exists(state_path):
+            state.save()
+        return result
+
+
+def exchange_changes(vault, client, state, resend=False):
+    """Send the changes made here and apply those received in one exchange.
+
+    With ``resend`` every entry and deletion is sent, entries unchanged
+    since the last sync under their old version, so a fresh server does
+    not let a device that is behind overwrite newer edits. Returns None
+    if the server asks for that.
+    """
+    passwords = {password['id']: password for password in vault.get_passwords()}
+    digests = {password_id: vault.entry_digest(password) for password_id, password in passwords.items()}
+
+    changed_ids = [password_id for password_id, digest in digests.items() if resend or state.entries.get(password_id, (0, "", None))[2] != digest]
+    deleted_ids = [password_id for password_id, (_, _, digest) in state.entries.items() if password_id not in digests and (resend or digest is not None)]
+    changes = []
+    for row in vault.password_rows(passwords[password_id] for password_id in changed_ids):
+        changes.append([row[0], *state.version(row[0], digests[row[0]]), row[1:4]])
+    for password_id in deleted_ids:
+        changes.append([password_id, *state.version(password_id, None), None])
+
+    response = client.exchange({'vault': vault.key_id(), 'server': state.server, 'since': state.revision, 'changes': changes})
+    if response.get('reset'):
+        state.server = response['server']
+        state.revision = 0
+        return None
+
+    # Whatever the server sent back for a change sent here is a newer
+    # version that beat it; every other change was accepted
+    received = {password_id: [clock, device, fields] for password_id, clock, device, fields in response['changes']}
+    for password_id, clock, device, _ in changes:
+        if password_id not in received:
+            state.entries[password_id] = [clock, device, digests.get(password_id)]
+
+    updates = {}
+    for password_id, (clock, device, fields) in received.items():
+        state.clock = max(state.clock, clock)
+        if (clock, device) > tuple(state.entries.get(password_id, (0, ""))[:2]):
+            updates[password_id] = (clock, device, fields)
+    records = [(password_id, fields, None) for password_id, (_, _, fields) in updates.items()]
+    new_passwords = []
+    removed_ids = []
+    for (password_id, fields, _), password in zip(records, vault.decode_records(records)):
+        if password is None and fields is not None:
+            logger.warning("Skipping synced entry %s, which cannot be decrypted", password_id)
+        elif (password and vault.entry_digest(password)) == digests.get(password_id):
+            # Already the same here, e.g. on a first sync of a copied vault:
+            # only its version is new
+            clock, device, _ = updates[password_id]
+            state.entries[password_id] = [clock, device, digests.get(password_id)]
+        elif fields is None:
+            removed_ids.append(password_id)
+        else:
+            new_passwords.append(password)
+
+    applied = vault.merge(new_passwords, removed_ids, {password_id: digests.get(password_id) for password_id in updates})
+    merged = {password['id']: password for password in new_passwords}
+    for password_id in applied:
+        clock, device, _ = updates[password_id]
+        password = merged.get(password_id)
+        state.entries[password_id] = [clock, device, password and vault.entry_digest(password)]
+
+    state.server = response['server']
+    state.revision = response['revision']
+    return len(changes), len(applied)
+
+
+class SyncServer:
+    """Reference sync server keeping the newest version of every entry.
+
+    The entries of each vault are kept in revision order, so the changes
+    after a revision are read from the end rather than found by a scan.
+    With a ``data_file`` they are saved there after every change; without
+    one they live only as long as the process.
+    """
+
+    def __init__(self, data_file=None):
+        self.data_file = data_file
+        self.lock = threading.Lock()
+        # Tells clients this server apart from any other or an earlier empty one
+        self.epoch = uuid.uuid4().hex
+        self.vaults = {}
+        if data_file and os.path.exists(data_file):
+            with open(data_file) as f:
+                data = json.load(f)
+            self.epoch = data['epoch']
+            self.vaults = data['vaults']
+
+    def sync(self, request):
+        with self.lock:
+            if request['server'] not in (None, self.epoch):
+                return {'server': self.epoch, 'reset': True}
+            vault = self.vaults.setdefault(request['vault'], {'revision': 0, 'entries': {}})
+            entries = vault['entries']
+            since = request['since']
+            start_revision = vault['revision']
+
+            # Entries the client is known to have, and older changes it sent
+            current = set()
+            rejected = set()
+            for password_id, clock, device, fields in request['changes']:
+                entry = entries.get(password_id)
+                if entry is not None and (entry[1], entry[2]) == (clock, device):
+                    current.add(password_id)
+                    continue
+                if entry is not None and (entry[1], entry[2]) > (clock, device):
+                    rejected.add(password_id)
+                    continue
+                vault['revision'] += 1
+                # Re-inserted so the entries stay in revision order
+                entries.pop(password_id, None)
+                entries[password_id] = [vault['revision'], clock, device, fields]
+                current.add(password_id)
+
+            changes = []
+            for password_id in reversed(entries):
+                revision, clock, device, fields = entries[password_id]
+                if revision <= since:
+                    break
+                if password_id not in current:
+                    changes.append([password_id, clock, device, fields])
+            for password_id in rejected:
+                revision, clock, device, fields = entries[password_id]
+                if revision <= since:
+                    changes.append([password_id, clock, device, fields])
+
+            if self.data_file and vault['revision'] != start_revision:
+                self.save()
+            return {'server': self.epoch, 'revision': vault['revision'], 'changes': changes}
+
+    def save(self):
+        temp_file = self.data_file + ".tmp"
+        with open(temp_file, "w") as f:
+            f.write(json.dumps({'epoch': self.epoch, 'vaults': self.vaults}, separators=(",", ":")))
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(temp_file, self.data_file)
+
+
+class SyncRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != "/sync":
+            self.send_error(404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            response = self.server.sync_server.sync(request)
+        except (ValueError, KeyError, TypeError) as error:
+            self.send_error(400, f"Bad sync request: {error}")
+            return
+        body = json.dumps(response, separators=(",", ":")).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+
+def make_server(host=SYNC_HOST, port=SYNC_PORT, data_file=None):
+    """Return an HTTP server for SyncServer; port 0 picks a free one."""
+    server = http.server.ThreadingHTTPServer((host, port), SyncRequestHandler)
+    server.sync_server = SyncServer(data_file)
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mux Password Manager reference sync server")
+    parser.add_argument("--host", default=SYNC_HOST, help=f"address to listen on (default: {SYNC_HOST})")
+    parser.add_argument("--port", type=int, default=SYNC_PORT, help=f"port to listen on (default: {SYNC_PORT})")
+    parser.add_argument("--data", help="file to keep the synced vaults in (default: memory only)")
+    args = parser.parse_args(argv)
+
+    server = make_server(args.host, args.port, args.data)
+    print(f"Sync server listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
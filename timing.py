@@ -0,0 +1,108 @@
+"""Opt-in timing of the vault and UI hot paths.
+
+Set MUX_TIMING=1 to record how long loading, saving, encryption,
+decryption and building the Passwords page take. When the process exits
+the call counts and latency percentiles are written to stderr as JSON, or
+to the file MUX_TIMING names if it is not 1. Timing is off by default, and
+timed() then returns functions unwrapped, so it costs nothing.
+"""
+
+import atexit
+import collections
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TIMING_SETTING = os.environ.get("MUX_TIMING", "")
+ENABLED = TIMING_SETTING not in ("", "0")
+
+# Latest samples kept per name; counts and totals cover every call
+MAX_SAMPLES = 10000
+
+PERCENTILES = (50, 90, 99)
+
+_lock = threading.Lock()
+_samples = {}
+_counts = collections.Counter()
+_totals = collections.Counter()
+
+
+def timed(name):
+    """Decorator recording how long each call of the function takes under ``name``."""
+    def decorate(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def record(name, seconds):
+    """Record one sample of ``seconds`` under ``name`` if timing is on."""
+    if not ENABLED:
+        return
+    with _lock:
+        samples = _samples.get(name)
+        if samples is None:
+            samples = _samples[name] = collections.deque(maxlen=MAX_SAMPLES)
+        samples.append(seconds)
+        _counts[name] += 1
+        _totals[name] += seconds
+
+
+def report():
+    """Return ``{name: stats}`` with the count, total and percentiles in ms."""
+    with _lock:
+        samples = {name: sorted(values) for name, values in _samples.items()}
+        counts = dict(_counts)
+        totals = dict(_totals)
+
+    stats = {}
+    for name, values in sorted(samples.items()):
+        entry = {'count': counts[name], 'total_ms': round(totals[name] * 1000, 3)}
+        for percentile in PERCENTILES:
+            # Nearest rank over the kept samples
+            rank = max(0, -(-percentile * len(values) // 100) - 1)
+            entry[f'p{percentile}_ms'] = round(values[rank] * 1000, 3)
+        entry['max_ms'] = round(values[-1] * 1000, 3)
+        stats[name] = entry
+    return stats
+
+
+def reset():
+    with _lock:
+        _samples.clear()
+        _counts.clear()
+        _totals.clear()
+
+
+def dump():
+    stats = report()
+    if not stats:
+        return
+    text = json.dumps(stats, indent=2)
+    if TIMING_SETTING == "1":
+        print(text, file=sys.stderr)
+        return
+    try:
+        with open(TIMING_SETTING, "w") as f:
+            f.write(text + "\n")
+    except OSError as error:
+        logger.warning("Cannot write timings to %s: %s", TIMING_SETTING, error)
+
+
+if ENABLED:
+    atexit.register(dump)
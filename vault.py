@@ -0,0 +1,973 @@
+"""Encryption, indexing and import/export of the password vault.
+
+This module has no GTK dependency, so scripts and the command line can use
+the vault without paying for GUI initialization.
+"""
+import os
+import base64
+import collections
+import csv
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import logging
+import multiprocessing
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+from storage import LoadCancelled, batched, check_header, open_storage, replace_file
+from timing import record, timed
+
+logger = logging.getLogger(__name__)
+
+# Longest substring kept in the search index
+SEARCH_GRAM_SIZE = 3
+
+# Records read between two progress reports while loading
+PROGRESS_INTERVAL = 1000
+
+# Entries handled by one worker task during import and export
+BULK_BATCH_SIZE = 500
+BULK_WORKERS = 4
+
+# First line of an encrypted backup written by export_passwords(), and of
+# the older backups sealed under the vault key without a header of their own
+BACKUP_HEADER = "MUXBACKUP3"
+LEGACY_BACKUP_HEADER = "MUXBACKUP2"
+
+# Vault files looked for when none is given, in order of preference
+DEFAULT_VAULT_FILES = ("passwords.db", "passwords.csv")
+
+# Version of the row format, kept in the header
+VAULT_FORMAT = 2
+
+# Random nonce in front of every AES-GCM encrypted field, and its tag at the end
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+# Revealed passwords kept for reuse, and for how many seconds at most
+SECRET_CACHE_SIZE = 8
+SECRET_CACHE_SECONDS = 30
+
+# Batches at least this large are spread over processes when asked to
+PROCESS_BATCH_THRESHOLD = 20000
+
+# Unlock time the scrypt cost is calibrated to, and the bounds for its n.
+# scrypt needs 128 * r * n bytes, so n stops at the memory budget, which a
+# smaller machine sharing the vault must still be able to spare
+KDF_TARGET_SECONDS = 0.5
+KDF_MIN_N = 2 ** 14
+KDF_MAX_MEMORY = 128 * 1024 * 1024
+
+
+def read_import_rows(path):
+    """Yield ``(name, link, password)`` from a CSV exported by another manager.
+
+    The columns are picked from the header row, which covers browser
+    exports (Chrome, Firefox), KeePass/KeePassXC and plain
+    name/link/password files. Usernames are kept as part of the name.
+    """
+    with open(path, "r", newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        columns = {field.strip().lower(): field for field in reader.fieldnames or []}
+
+        def find_column(*names):
+            return next((columns[name] for name in names if name in columns), None)
+
+        name_column = find_column("name", "title", "account")
+        link_column = find_column("url", "link", "web site", "website")
+        username_column = find_column("username", "login name", "user name", "login")
+        password_column = find_column("password")
+        if password_column is None:
+            raise ValueError(f"No password column found in {path}")
+
+        for row in reader:
+            password = row.get(password_column) or ""
+            if not password:
+                continue
+            name = (row.get(name_column) or "").strip()
+            link = (row.get(link_column) or "").strip()
+            username = (row.get(username_column) or "").strip()
+            if not name:
+                name = urlparse(link).hostname or link
+            if username:
+                name = f"{name} ({username})"
+            yield name, link, password
+
+
+def is_backup_file(path):
+    with open(path, "r", errors="replace") as f:
+        return f.readline().strip() in (BACKUP_HEADER, LEGACY_BACKUP_HEADER)
+
+
+def read_backup_header(path):
+    """Return the vault header kept in a backup, None for an older backup."""
+    with open(path, "r", errors="replace") as f:
+        if f.readline().strip() != BACKUP_HEADER:
+            return None
+        return json.loads(f.readline())
+
+
+def derive_key(master_password, kdf):
+    """Derive a Fernet key from ``master_password`` with a header's KDF parameters."""
+    scrypt = Scrypt(salt=base64.b64decode(kdf['salt']), length=32, n=kdf['n'], r=kdf['r'], p=kdf['p'])
+    return base64.urlsafe_b64encode(scrypt.derive(master_password.encode()))
+
+
+def calibrate_kdf(target_seconds=KDF_TARGET_SECONDS, max_memory=KDF_MAX_MEMORY):
+    """Pick scrypt parameters that take about ``target_seconds`` on this machine
+    without needing more than ``max_memory`` bytes."""
+    kdf = {'name': "scrypt", 'salt': base64.b64encode(os.urandom(16)).decode(), 'n': KDF_MIN_N, 'r': 8, 'p': 1}
+    start = time.perf_counter()
+    derive_key("calibration", kdf)
+    elapsed = time.perf_counter() - start
+
+    # scrypt time grows linearly with n, so keep doubling the estimate
+    while 128 * kdf['r'] * kdf['n'] * 2 <= max_memory and elapsed * 2 <= target_seconds:
+        kdf['n'] *= 2
+        elapsed *= 2
+    # Past the memory budget, p adds time at the same memory: its lanes run
+    # one after the other
+    while elapsed * 2 <= target_seconds:
+        kdf['p'] *= 2
+        elapsed *= 2
+    return kdf
+
+
+def default_vault_file():
+    """Return the vault file to open when none is given.
+
+    A vault migrated to SQLite wins over the passwords.csv it came from.
+    """
+    return next((path for path in DEFAULT_VAULT_FILES if os.path.exists(path)), DEFAULT_VAULT_FILES[-1])
+
+
+def read_header(passwords_file):
+    """Return the header of ``passwords_file``, or None for an unprotected vault."""
+    return open_storage(passwords_file).read_header()
+
+
+def create_header(master_password, key, target_seconds=KDF_TARGET_SECONDS):
+    """Return a header storing ``key`` wrapped under ``master_password``."""
+    kdf = calibrate_kdf(target_seconds)
+    wrapped_key = Fernet(derive_key(master_password, kdf)).encrypt(key)
+    return {'format': VAULT_FORMAT, 'kdf': kdf, 'key': wrapped_key.decode()}
+
+
+def unlock_key(header, master_password):
+    """Return the vault key wrapped in ``header``.
+
+    Raises InvalidToken if ``master_password`` is wrong.
+    """
+    return Fernet(derive_key(master_password, header['kdf'])).decrypt(header['key'].encode())
+
+
+def open_vault(master_password, passwords_file="passwords.csv", key_file="secret.key"):
+    """Unlock the vault in ``passwords_file`` with ``master_password``.
+
+    Unlocking runs the KDF once; the data key then stays in the returned
+    Vault for the rest of the session.
+
+    Older vaults are upgraded on first unlock: their Fernet key, either
+    wrapped in the header or read from ``key_file``, is used once to
+    re-encrypt every entry under a new data key, and the plaintext key file
+    is removed. Raises InvalidToken if ``master_password`` is wrong.
+    """
+    header = read_header(passwords_file)
+    if header:
+        key = unlock_key(header, master_password)
+        if header.get('format') == VAULT_FORMAT:
+            return Vault(key, passwords_file, header=header)
+        legacy_key = key
+    elif os.path.exists(key_file):
+        with open(key_file, "rb") as f:
+            legacy_key = f.read()
+    elif os.path.exists(passwords_file) and os.path.getsize(passwords_file):
+        raise FileNotFoundError(f"{key_file} is needed to open {passwords_file}")
+    else:
+        legacy_key = None
+
+    key = AESGCM.generate_key(bit_length=256)
+    vault = Vault(key, passwords_file, header=create_header(master_password, key))
+    # Rewrites the file in the new format before the key file goes away
+    vault.upgrade(legacy_key)
+    if os.path.exists(key_file):
+        os.remove(key_file)
+    return vault
+
+
+def seal_fields(cipher, items):
+    """Encrypt ``(password_id, field, value)`` items with one AES-GCM cipher.
+
+    Returns the tokens in the same order. All nonces come from a single
+    os.urandom() call and are sliced through a memoryview, so a batch costs
+    one syscall and no per-item nonce copies.
+    """
+    nonces = memoryview(os.urandom(NONCE_SIZE * len(items)))
+    encrypt = cipher.encrypt
+    encode = base64.urlsafe_b64encode
+    tokens = []
+    for index, (password_id, field, value) in enumerate(items):
+        nonce = nonces[index * NONCE_SIZE:(index + 1) * NONCE_SIZE]
+        tokens.append(encode(nonce.tobytes() + encrypt(nonce, value.encode(), f"{password_id}:{field}".encode())))
+    return tokens
+
+
+def open_fields(cipher, items):
+    """Decrypt ``(password_id, field, token)`` items with one AES-GCM cipher.
+
+    Returns the plaintexts in the same order, with None for any token that
+    fails to decode or authenticate.
+    """
+    decrypt = cipher.decrypt
+    decode = base64.urlsafe_b64decode
+    values = []
+    for password_id, field, token in items:
+        try:
+            # Plain slices: for tokens this small a memoryview costs more
+            # than the copies it saves
+            data = decode(token)
+            values.append(decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], f"{password_id}:{field}".encode()).decode())
+        except (InvalidTag, ValueError):
+            values.append(None)
+    return values
+
+
+def seal_chunk(key, items):
+    # Process pool entry point; cipher objects cannot be pickled
+    return seal_fields(AESGCM(key), items)
+
+
+def open_chunk(key, items):
+    return open_fields(AESGCM(key), items)
+
+
+def wipe(buffer):
+    """Overwrite a bytearray or writable memoryview with zeros in place."""
+    buffer[:] = bytes(len(buffer))
+
+
+def open_secret(key, password_id, field, token):
+    """Decrypt one field straight into a Secret.
+
+    Unlike open_fields() no immutable copy of the plaintext is made, so
+    wiping the Secret removes it from memory. Raises InvalidTag if the
+    token does not authenticate.
+    """
+    data = base64.urlsafe_b64decode(token)
+    decryptor = Cipher(algorithms.AES(key), modes.GCM(data[:NONCE_SIZE], data[-TAG_SIZE:])).decryptor()
+    decryptor.authenticate_additional_data(f"{password_id}:{field}".encode())
+    sealed = data[NONCE_SIZE:-TAG_SIZE]
+    # update_into() wants room for one block more than it writes
+    buffer = bytearray(len(sealed) + 15)
+    size = decryptor.update_into(sealed, buffer)
+    try:
+        decryptor.finalize()
+    except InvalidTag:
+        wipe(buffer)
+        raise
+    return Secret(buffer, size)
+
+
+class Secret:
+    """Plaintext held in a bytearray that wipe() overwrites with zeros.
+
+    Use it as a context manager to wipe it when done. text() makes a str,
+    which cannot be wiped, so only call it to hand the value to GTK.
+    """
+
+    def __init__(self, buffer, size=None):
+        self.buffer = buffer
+        self.size = len(buffer) if size is None else size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wipe()
+
+    def __len__(self):
+        return self.size
+
+    def view(self):
+        return memoryview(self.buffer)[:self.size]
+
+    def text(self):
+        return str(self.view(), "utf-8")
+
+    def copy(self):
+        return Secret(bytearray(self.view()))
+
+    def wipe(self):
+        wipe(self.buffer)
+        self.size = 0
+
+
+class SecretCache:
+    """Bounded LRU cache of revealed secrets that expire after ``seconds``.
+
+    The cache keeps its own copies and wipes them when they are evicted,
+    expire or clear() is called, e.g. when the app locks.
+    """
+
+    def __init__(self, size=SECRET_CACHE_SIZE, seconds=SECRET_CACHE_SECONDS):
+        self.size = size
+        self.seconds = seconds
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return a copy of the secret under ``key``, or None."""
+        with self.lock:
+            self.purge_expired()
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1].copy()
+
+    def put(self, key, secret):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                old[1].wipe()
+            self.entries[key] = (time.monotonic() + self.seconds, secret.copy())
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)[1][1].wipe()
+
+    def purge_expired(self):
+        now = time.monotonic()
+        while self.entries:
+            key, (expires, secret) = next(iter(self.entries.items()))
+            if expires > now:
+                break
+            del self.entries[key]
+            secret.wipe()
+
+    def clear(self):
+        with self.lock:
+            for _, secret in self.entries.values():
+                secret.wipe()
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Vault:
+    """In-memory view of a vault kept in a storage backend (see storage.py).
+
+    The storage is read once and afterwards only what other instances wrote
+    since is read back. Every change first catches up with the storage under
+    its lock and is then applied on top, so concurrent changes merge per
+    entry, the last writer winning, instead of overwriting one another.
+
+    Names, links and passwords are each encrypted on disk with AES-GCM under
+    the single data ``key``, using a 12-byte random nonce and the entry id
+    and field as associated data, so fields cannot be swapped between rows.
+    Names and links are decrypted once at load for the list and search;
+    passwords stay encrypted in memory until they are revealed. Names are
+    also stored as a keyed hash, for storages that look them up by index.
+    The optional ``header`` (see open_vault()) is kept by the storage.
+
+    Entries are keyed by a stable id, with a second index from normalized
+    name, so lookups, edits and deletes never scan the whole vault. A gram
+    index over names and links answers substring searches the same way.
+    Indexed storages answer get(), find_by_name() and get_page() directly,
+    without loading the whole vault first.
+    """
+
+    def __init__(self, key, passwords_file="passwords.csv", header=None, compact_threshold=64 * 1024):
+        self.key = key
+        self.cipher = AESGCM(key)
+        self.name_key = hmac.new(key, b"name index", hashlib.sha256).digest()
+        self.legacy_fernet = None
+        self.header = header
+        self.passwords_file = passwords_file
+        self.storage = open_storage(passwords_file, header, compact_threshold)
+        self.passwords = {}
+        self.name_index = {}
+        self.search_index = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+        self.secrets = SecretCache()
+
+    def encrypt_field(self, password_id, field, value):
+        nonce = os.urandom(NONCE_SIZE)
+        sealed = self.cipher.encrypt(nonce, value.encode(), f"{password_id}:{field}".encode())
+        return base64.urlsafe_b64encode(nonce + sealed)
+
+    def decrypt_field(self, password_id, field, token):
+        data = base64.urlsafe_b64decode(token)
+        return self.cipher.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], f"{password_id}:{field}".encode()).decode()
+
+    @timed("vault.encrypt_many")
+    def encrypt_many(self, items, processes=None):
+        """Encrypt a sequence of ``(password_id, field, value)`` items.
+
+        Large batches are split over ``processes`` worker processes when
+        given; otherwise the vault's cipher is reused for every item.
+        """
+        return self.run_batch(seal_fields, seal_chunk, list(items), processes)
+
+    @timed("vault.decrypt_many")
+    def decrypt_many(self, items, processes=None):
+        """Decrypt a sequence of ``(password_id, field, token)`` items.
+
+        Returns None in place of any token that fails to authenticate.
+        """
+        return self.run_batch(open_fields, open_chunk, list(items), processes)
+
+    def run_batch(self, run, run_chunk, items, processes):
+        if not processes or len(items) < PROCESS_BATCH_THRESHOLD:
+            return run(self.cipher, items)
+        chunk_size = -(-len(items) // processes)
+        chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+        # Spawned rather than forked, as the GUI process runs other threads
+        with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+            return [value for chunk in executor.map(run_chunk, itertools.repeat(self.key), chunks) for value in chunk]
+
+    def decrypt_passwords(self, passwords, processes=None):
+        """Return the plaintext of each entry's password, in order."""
+        values = self.decrypt_many([(password['id'], "password", password['password']) for password in passwords], processes)
+        if None in values:
+            raise InvalidTag()
+        return values
+
+    def new_entry(self, name, link, password, password_id=None):
+        """Return an entry with ``password`` encrypted, ready for add() or replace()."""
+        password_id = password_id or uuid.uuid4().hex
+        return {
+            'id': password_id,
+            'name': name,
+            'link': link,
+            'password': self.encrypt_field(password_id, "password", password)
+        }
+
+    @timed("vault.decrypt_password")
+    def decrypt_password(self, password):
+        return self.decrypt_field(password['id'], "password", password['password'])
+
+    @timed("vault.reveal_password")
+    def reveal_password(self, password):
+        """Return the password of an entry as a Secret the caller must wipe.
+
+        Recently revealed passwords come from the secret cache instead of
+        being decrypted again; forget_secrets() empties it.
+        """
+        # Keyed by the sealed token too, so an edited entry is not served stale
+        key = (password['id'], password['password'])
+        secret = self.secrets.get(key)
+        if secret is None:
+            secret = open_secret(self.key, password['id'], "password", password['password'])
+            self.secrets.put(key, secret)
+        return secret
+
+    def forget_secrets(self):
+        self.secrets.clear()
+
+    def encrypt_batch(self, rows):
+        """Return entries for ``(name, link, password)`` rows under new ids.
+
+        Rows of ``(id, name, link, password)`` keep their id unless it is None.
+        """
+        rows = [row if len(row) == 4 else (None, *row) for row in rows]
+        password_ids = [row[0] or uuid.uuid4().hex for row in rows]
+        tokens = self.encrypt_many([(password_id, "password", row[3]) for password_id, row in zip(password_ids, rows)])
+        return [
+            {'id': password_id, 'name': name, 'link': link, 'password': token}
+            for password_id, (_, name, link, _), token in zip(password_ids, rows, tokens)
+        ]
+
+    def refresh(self, progress=None):
+        if self.loaded and not self.storage.changed():
+            return
+        start = time.perf_counter()
+        with self.storage.lock(shared=True):
+            self.check_key()
+            snapshot = self.storage.snapshot()
+            if self.loaded and self.storage.can_replay(snapshot):
+                # Another instance only wrote a few records: apply just those
+                self.apply_records(self.storage.read_records(PROGRESS_INTERVAL, since_sync=True))
+                record("vault.replay", time.perf_counter() - start)
+            else:
+                self.loaded = False
+                self.passwords = {}
+                self.name_index = {}
+                self.search_index = {}
+                self.apply_records(self.storage.read_records(PROGRESS_INTERVAL, legacy=self.legacy_fernet is not None), progress)
+                record("vault.load", time.perf_counter() - start)
+            self.storage.mark_synced(snapshot)
+            self.loaded = True
+
+    def catch_up(self):
+        # Indexed storages are written to without loading the whole vault
+        if self.loaded or not self.storage.indexed:
+            self.refresh()
+        else:
+            self.check_key()
+
+    def check_key(self):
+        """Raise KeyChanged if the storage is now sealed under another key.
+
+        Its rows would all fail to decrypt here, and rows written here
+        under the old key would be lost on the next rotation.
+        """
+        check_header(self.storage.read_header(), self.header)
+
+    def apply_records(self, batches, progress=None):
+        # Records are decrypted a batch at a time, which is also when
+        # progress is reported
+        for records, fraction in batches:
+            for (password_id, fields, position), password in zip(records, self.decode_records(records)):
+                if fields is not None and password is None:
+                    self.storage.report_corrupt_line(position, "cannot be decrypted")
+                    continue
+                old_password = self.passwords.get(password_id)
+                if old_password is not None:
+                    self.unindex_entry(old_password)
+                if password is None:
+                    self.passwords.pop(password_id, None)
+                else:
+                    # Edited entries keep their place in the list
+                    self.passwords[password_id] = password
+                    self.index_entry(password)
+            if progress and progress(fraction) is False:
+                raise LoadCancelled()
+
+    def decode_records(self, records):
+        """Return the entry for each of ``records``, or None where there is none."""
+        rows = [(password_id, fields) for password_id, fields, _ in records if fields is not None]
+        if self.legacy_fernet:
+            values = []
+            for password_id, (name, link, encrypted_password) in rows:
+                try:
+                    values.append(self.legacy_fernet.decrypt(encrypted_password.encode()).decode())
+                except InvalidToken:
+                    values.append(None)
+            tokens = self.encrypt_many([(password_id, "password", value or "") for (password_id, _), value in zip(rows, values)])
+            entries = [
+                {'id': password_id, 'name': name, 'link': link, 'password': token} if value is not None else None
+                for (password_id, (name, link, _)), value, token in zip(rows, values, tokens)
+            ]
+        else:
+            names = self.decrypt_many([(password_id, "name", fields[0]) for password_id, fields in rows])
+            links = self.decrypt_many([(password_id, "link", fields[1]) for password_id, fields in rows])
+            entries = [
+                {'id': password_id, 'name': name, 'link': link, 'password': fields[2].encode()}
+                if name is not None and link is not None else None
+                for (password_id, fields), name, link in zip(rows, names, links)
+            ]
+
+        entries = iter(entries)
+        return [next(entries) if fields is not None else None for _, fields, _ in records]
+
+    def normalize_name(self, name):
+        return name.strip().casefold()
+
+    def get_name_hash(self, name, name_key=None):
+        if not self.storage.indexed:
+            # Only indexed storages keep the hash; the rest skip its cost
+            return ""
+        return hmac.new(name_key or self.name_key, self.normalize_name(name).encode(), hashlib.sha256).hexdigest()
+
+    def get_search_grams(self, password):
+        # Every substring of up to three characters of the name and link, so
+        # short queries are a single lookup and longer ones intersect trigrams
+        grams = set()
+        for text in (password['name'].casefold(), password['link'].casefold()):
+            for size in range(1, SEARCH_GRAM_SIZE + 1):
+                for start in range(len(text) - size + 1):
+                    grams.add(text[start:start + size])
+        return grams
+
+    def index_entry(self, password):
+        key = self.normalize_name(password['name'])
+        self.name_index.setdefault(key, {})[password['id']] = password
+        for gram in self.get_search_grams(password):
+            self.search_index.setdefault(gram, set()).add(password['id'])
+
+    def unindex_entry(self, password):
+        key = self.normalize_name(password['name'])
+        entries = self.name_index[key]
+        del entries[password['id']]
+        if not entries:
+            del self.name_index[key]
+        for gram in self.get_search_grams(password):
+            ids = self.search_index[gram]
+            ids.discard(password['id'])
+            if not ids:
+                del self.search_index[gram]
+
+    def search(self, query):
+        """Return the ids of entries whose name or link contains ``query``.
+
+        Only the entries already in memory are searched, so a keystroke never
+        reads the disk; get_passwords() picks up changes made elsewhere.
+        """
+        query = query.casefold()
+        with self.lock:
+            if len(query) <= SEARCH_GRAM_SIZE:
+                return set(self.search_index.get(query, ()))
+
+            grams = [query[start:start + SEARCH_GRAM_SIZE] for start in range(len(query) - SEARCH_GRAM_SIZE + 1)]
+            postings = sorted((self.search_index.get(gram, set()) for gram in grams), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+            # Trigrams can all match without the whole query doing so
+            return {
+                password_id for password_id in candidates
+                if query in self.passwords[password_id]['name'].casefold()
+                or query in self.passwords[password_id]['link'].casefold()
+            }
+
+    def get_passwords(self, progress=None):
+        """Return every entry, loading the vault first if needed.
+
+        ``progress`` is called with the fraction of the vault read so far
+        while loading; if it returns False the load stops and LoadCancelled
+        is raised.
+        """
+        with self.lock:
+            self.refresh(progress)
+            return list(self.passwords.values())
+
+    @timed("vault.get_page")
+    def get_page(self, cursor=None, limit=100, progress=None):
+        """Return up to ``limit`` entries after ``cursor`` and the next cursor.
+
+        Pages follow the order of get_passwords(); the next cursor is None
+        after the last page. Indexed storages read just the page, so the
+        first screen of a large vault shows without loading all of it.
+        Other storages load the whole vault first, reporting ``progress``
+        as get_passwords() does.
+        """
+        with self.lock:
+            if self.storage.indexed and not self.loaded:
+                self.check_key()
+                records, cursor = self.storage.read_page(cursor, limit)
+                return [password for password in self.decode_records(records) if password is not None], cursor
+            self.refresh(progress)
+            start = cursor or 0
+            passwords = list(itertools.islice(self.passwords.values(), start, start + limit))
+            return passwords, start + limit if start + limit < len(self.passwords) else None
+
+    def get(self, password_id):
+        with self.lock:
+            if self.storage.indexed and not self.loaded:
+                self.check_key()
+                return next(iter(self.decode_records(self.storage.read_ids([password_id]))), None)
+            self.refresh()
+            return self.passwords.get(password_id)
+
+    def find_by_name(self, name):
+        with self.lock:
+            if self.storage.indexed and not self.loaded:
+                self.check_key()
+                passwords = self.decode_records(self.storage.read_name_hash(self.get_name_hash(name)))
+                return [password for password in passwords if password and self.normalize_name(password['name']) == self.normalize_name(name)]
+            self.refresh()
+            return list(self.name_index.get(self.normalize_name(name), {}).values())
+
+    def add(self, password):
+        self.add_many([password])
+
+    def add_many(self, passwords):
+        """Add several entries and persist them with a single write."""
+        with self.lock, self.storage.lock():
+            self.catch_up()
+            if self.loaded:
+                for password in passwords:
+                    self.passwords[password['id']] = password
+                    self.index_entry(password)
+            self.storage.add(self.password_rows(passwords))
+
+    def replace(self, password_id, new_password):
+        new_password['id'] = password_id
+        self.replace_many([new_password])
+
+    def replace_many(self, passwords):
+        """Write several entries over those with the same ids in one write."""
+        # Edits of an entry another instance deleted in the meantime bring
+        # it back rather than fail
+        with self.lock, self.storage.lock():
+            self.catch_up()
+            if self.loaded:
+                for password in passwords:
+                    if password['id'] in self.passwords:
+                        self.unindex_entry(self.passwords[password['id']])
+                    self.passwords[password['id']] = password
+                    self.index_entry(password)
+            self.storage.update(self.password_rows(passwords))
+
+    def remove(self, password_id):
+        with self.lock, self.storage.lock():
+            self.catch_up()
+            if self.loaded:
+                if password_id not in self.passwords:
+                    # Already deleted by another instance
+                    return
+                self.unindex_entry(self.passwords.pop(password_id))
+            self.storage.delete([password_id])
+
+    def merge(self, passwords, deleted_ids, expected_digests):
+        """Apply entries and deletions synced from another machine.
+
+        An entry is only overwritten or deleted while its entry_digest()
+        still matches ``expected_digests`` (None for an absent entry), so
+        a change made here in the meantime is kept. Returns the ids that
+        were applied.
+        """
+        with self.lock, self.storage.lock():
+            self.refresh()
+            applied = []
+            removed_ids = []
+            new_passwords = []
+            changed_passwords = []
+            for password_id in deleted_ids:
+                old_password = self.passwords.get(password_id)
+                if expected_digests.get(password_id) != (old_password and self.entry_digest(old_password)):
+                    continue
+                if old_password is not None:
+                    self.unindex_entry(self.passwords.pop(password_id))
+                    removed_ids.append(password_id)
+                applied.append(password_id)
+            for password in passwords:
+                old_password = self.passwords.get(password['id'])
+                if expected_digests.get(password['id']) != (old_password and self.entry_digest(old_password)):
+                    continue
+                if old_password is None:
+                    new_passwords.append(password)
+                else:
+                    self.unindex_entry(old_password)
+                    changed_passwords.append(password)
+                self.passwords[password['id']] = password
+                self.index_entry(password)
+                applied.append(password['id'])
+            # One write of each kind, however many entries a sync brings
+            if removed_ids:
+                self.storage.delete(removed_ids)
+            if changed_passwords:
+                self.storage.update(self.password_rows(changed_passwords))
+            if new_passwords:
+                self.storage.add(self.password_rows(new_passwords))
+            return applied
+
+    def entry_digest(self, password):
+        """Return a keyed digest of an entry that changes whenever it is edited.
+
+        Sealing a field picks a new nonce each time, so the digest covers
+        the plaintext name and link and the sealed password, which is only
+        resealed when the password changes.
+        """
+        message = "\0".join((password['id'], password['name'], password['link'], password['password'].decode()))
+        # Keyed BLAKE2b: a MAC like HMAC, at a third of its cost per entry
+        return hashlib.blake2b(message.encode(), key=self.name_key, digest_size=16).hexdigest()
+
+    def key_id(self):
+        """Return an id of the data key that does not reveal it."""
+        return hmac.new(self.key, b"key id", hashlib.sha256).hexdigest()[:32]
+
+    def password_rows(self, passwords):
+        passwords = list(passwords)
+        items = []
+        for password in passwords:
+            items.append((password['id'], "name", password['name']))
+            items.append((password['id'], "link", password['link']))
+        tokens = self.encrypt_many(items)
+        return [
+            [
+                password['id'], tokens[2 * index].decode(), tokens[2 * index + 1].decode(),
+                password['password'].decode(), self.get_name_hash(password['name'])
+            ]
+            for index, password in enumerate(passwords)
+        ]
+
+    def upgrade(self, legacy_key):
+        """Re-encrypt an older vault under this vault's key and header.
+
+        ``legacy_key`` is the Fernet key its passwords were encrypted with,
+        or None for a vault that has no entries yet.
+        """
+        with self.lock, self.storage.lock():
+            self.legacy_fernet = Fernet(legacy_key) if legacy_key else None
+            try:
+                self.refresh()
+            finally:
+                self.legacy_fernet = None
+            self.save_passwords(self.passwords.values())
+
+    @timed("vault.save")
+    def save_passwords(self, passwords):
+        self.storage.save(row for chunk in batched(passwords, BULK_BATCH_SIZE) for row in self.password_rows(chunk))
+
+    def copy_to(self, passwords_file):
+        """Copy every entry into a new vault file under the same key and header.
+
+        This is how a vault moves between storages, e.g. from passwords.csv
+        to passwords.db. Returns the number of entries and the time it took.
+        """
+        start = time.perf_counter()
+        passwords = self.get_passwords()
+        target = Vault(self.key, passwords_file, header=self.header)
+        with target.lock, target.storage.lock():
+            if target.storage.exists():
+                raise FileExistsError(f"{passwords_file} already holds a vault")
+            target.save_passwords(passwords)
+        return len(passwords), time.perf_counter() - start
+
+    def rotate_key(self, master_password, progress=None):
+        """Re-encrypt the whole vault under a new data key.
+
+        The storage streams its records through the new key a batch at a
+        time, so memory stays bounded however big the vault is, and resumes
+        an interrupted or cancelled (``progress`` returned False) rotation
+        on the next call. Backups exported before the rotation keep the old
+        key wrapped under the master password, so they can still be restored.
+
+        Returns the number of records written and the time it took. Raises
+        InvalidToken if ``master_password`` is wrong, KeyChanged if another
+        instance rotated the key first, even while this rotation runs, and
+        ValueError if an entry cannot be decrypted. The vault is then left
+        under its old key, with every entry.
+        """
+        start = time.perf_counter()
+        with self.lock:
+            if unlock_key(self.header, master_password) != self.key:
+                raise InvalidToken()
+            self.check_key()
+            new_header = self.storage.pending_rotation()
+            if new_header:
+                new_key = unlock_key(new_header, master_password)
+            else:
+                new_key = AESGCM.generate_key(bit_length=256)
+                new_header = create_header(master_password, new_key)
+
+            new_cipher = AESGCM(new_key)
+            new_name_key = hmac.new(new_key, b"name index", hashlib.sha256).digest()
+            count = self.storage.rotate(self.header, new_header, lambda records: self.reseal(records, new_cipher, new_name_key), progress)
+
+            self.key = new_key
+            self.cipher = new_cipher
+            self.name_key = new_name_key
+            self.header = new_header
+            # Passwords held in memory are still sealed under the old key
+            self.loaded = False
+            self.forget_secrets()
+        return count, time.perf_counter() - start
+
+    def reseal(self, records, cipher, name_key):
+        """Return ``(id, fields)`` records sealed under ``cipher``, None where undecryptable."""
+        items = [(password_id, field, value) for password_id, fields in records for field, value in zip(("name", "link", "password"), fields)]
+        values = self.decrypt_many(items)
+        rows, plaintexts = [], []
+        for index, (password_id, _) in enumerate(records):
+            name, link, password = values[3 * index:3 * index + 3]
+            if None in (name, link, password):
+                rows.append(None)
+                continue
+            rows.append([password_id, None, None, None, self.get_name_hash(name, name_key)])
+            plaintexts += [(password_id, "name", name), (password_id, "link", link), (password_id, "password", password)]
+
+        tokens = iter(seal_fields(cipher, plaintexts))
+        for row in rows:
+            if row is not None:
+                row[1:4] = [next(tokens).decode(), next(tokens).decode(), next(tokens).decode()]
+        return rows
+
+    def import_passwords(self, path, master_password=None):
+        """Import every entry in ``path`` and commit them in one write.
+
+        ``path`` is either a CSV export of another manager or a backup made
+        by export_passwords(). Entries restored from a backup keep their
+        ids, so restoring into the vault it came from overwrites them
+        rather than adding copies. Returns the number of entries and the
+        time it took.
+
+        Raises InvalidToken if the backup needs its ``master_password`` (see
+        backup_needs_password()) and it is wrong or missing, and ValueError
+        if the file cannot be read.
+        """
+        start = time.perf_counter()
+        backup = is_backup_file(path)
+        rows = self.read_backup_rows(path, master_password) if backup else read_import_rows(path)
+        with ThreadPoolExecutor(max_workers=BULK_WORKERS) as executor:
+            passwords = [
+                password
+                for batch in executor.map(self.encrypt_batch, batched(rows, BULK_BATCH_SIZE))
+                for password in batch
+            ]
+        if backup:
+            self.replace_many(passwords)
+        else:
+            self.add_many(passwords)
+        return len(passwords), time.perf_counter() - start
+
+    def backup_needs_password(self, path):
+        """Return True if the backup in ``path`` was sealed under another key.
+
+        Backups of this vault since its last key rotation open with the
+        key in memory; any other needs the master password it was made under.
+        """
+        header = read_backup_header(path)
+        return bool(header) and not (self.header and header['key'] == self.header['key'])
+
+    def read_backup_rows(self, path, master_password=None):
+        """Yield ``(id, name, link, password)`` from a backup, the id None in older backups."""
+        cipher = self.cipher
+        if self.backup_needs_password(path):
+            if master_password is None:
+                raise InvalidToken()
+            cipher = AESGCM(unlock_key(read_backup_header(path), master_password))
+        with open(path, "r") as f:
+            legacy = f.readline().strip() == LEGACY_BACKUP_HEADER
+            if not legacy:
+                f.readline()  # The header read above
+            for line in f:
+                if line.strip():
+                    text, = open_fields(cipher, [("", "backup", line.strip())])
+                    if text is None:
+                        if legacy:
+                            raise ValueError(f"{path} is an older backup, which only the vault it came from can restore, before any key rotation")
+                        raise ValueError(f"{path} is damaged and cannot be decrypted")
+                    for row in csv.reader(io.StringIO(text)):
+                        yield (None, *row) if legacy else tuple(row)
+
+    def encrypt_backup_batch(self, passwords):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        for password, value in zip(passwords, self.decrypt_passwords(passwords)):
+            writer.writerow([password['id'], password['name'], password['link'], value])
+        return self.encrypt_field("", "backup", buffer.getvalue())
+
+    def export_passwords(self, path):
+        """Write an encrypted backup of the whole vault to ``path``.
+
+        Entries are decrypted and re-encrypted in batches, one encrypted
+        field per batch of rows, so names and links are protected too. The
+        vault header goes first, with the key wrapped under the master
+        password, so restoring needs only that password, even once the vault
+        file is lost or its key rotated. Returns the number of entries and
+        the time it took.
+        """
+        start = time.perf_counter()
+        passwords = self.get_passwords()
+        temp_file = path + ".tmp"
+        with ThreadPoolExecutor(max_workers=BULK_WORKERS) as executor, open(temp_file, "w") as f:
+            f.write(BACKUP_HEADER + "\n")
+            f.write(json.dumps(self.header) + "\n")
+            for token in executor.map(self.encrypt_backup_batch, batched(passwords, BULK_BATCH_SIZE)):
+                f.write(token.decode() + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(temp_file, path)
+        return len(passwords), time.perf_counter() - start